@@ -0,0 +1,197 @@
+import os
+import json
+import shutil
+import threading
+from collections import OrderedDict
+from SegmentStore import SegmentStore
+
+# fsync policies: "none" leaves flushing to the OS, "batch" syncs the files and directories written
+# in each drained batch, "always" syncs every file and its directory as it is written
+FSYNC_POLICIES = ("none", "batch", "always")
+
+WRITE = 0
+REMOVE = 1
+
+def sync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class JSONLogs:
+    # Backend writing each buffer log to its own JSON file
+
+    def write(self, log_addr, log, sync=False):
+        # Writes through a temporary file so a crash never leaves a partial log, and returns the file to sync
+        tmp_path = log_addr + ".tmp"
+        with open(tmp_path, 'w') as log_out:
+            json.dump(log, log_out)
+            if sync:
+                log_out.flush()
+                os.fsync(log_out.fileno())
+        os.replace(tmp_path, log_addr)
+        return log_addr
+
+    def remove(self, log_addr, sync=False):
+        try:
+            os.remove(log_addr)
+        except FileNotFoundError:
+            pass
+        return None
+
+    def close(self, metrics=None):
+        pass
+
+class BufferWriter:
+    # Class for writing buffer logs and deleting dropped buffers on a background thread
+    # Pending operations are keyed by path, so a later write to the same path replaces an earlier one
+    # and dropping a buffer whose log hasn't been written yet just cancels the write
+    # Paths taken for writing are remembered, so dropping a log with a pending rewrite still removes the first write
+
+    def __init__(self, max_pending=64, fsync="none", backend=None):
+        """
+        @param int max_pending: pending operations allowed before submit waits for the writer
+        @param str fsync: one of FSYNC_POLICIES
+        @param backend: where logs go, JSONLogs by default or a SegmentStore
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy " + str(fsync))
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self.backend = backend if backend is not None else JSONLogs()
+        self.pending = OrderedDict()
+        self.written = set()
+        self.busy = False
+        self.closed = False
+        self.error = None
+        self.stats = {"writes": 0, "writes_coalesced": 0, "writes_cancelled": 0, "removes": 0, "stalls": 0}
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.thread = threading.Thread(target=self._run, name="BufferWriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, path, log):
+        # Queues log to be written to path by the backend
+        self._put(path, (WRITE, log))
+
+    def drop(self, log_addr, frames_addr=None):
+        # Queues removal of a buffer's log and compressed frames, cancelling the log write if still pending
+        with self.lock:
+            self._check()
+            pending = self.pending.get(log_addr)
+            if pending is not None and pending[0] == WRITE:
+                del self.pending[log_addr]
+                self.stats["writes_cancelled"] += 1
+                cancelled = log_addr not in self.written
+            else:
+                cancelled = False
+        if not cancelled:
+            self._put(log_addr, (REMOVE, None))
+        if frames_addr is not None:
+            self._put(frames_addr, (REMOVE, None))
+
+    def _put(self, path, operation):
+        with self.lock:
+            self._check()
+            if path in self.pending:
+                if self.pending[path][0] == WRITE and operation[0] == WRITE:
+                    self.stats["writes_coalesced"] += 1
+                del self.pending[path]
+            elif len(self.pending) >= self.max_pending:
+                self.stats["stalls"] += 1
+                while len(self.pending) >= self.max_pending and self.error is None:
+                    self.changed.wait()
+                self._check()
+            self.pending[path] = operation
+            self.changed.notify_all()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("Buffer writer failed") from self.error
+        if self.closed:
+            raise RuntimeError("Buffer writer is closed")
+
+    def _run(self):
+        # Drains pending operations in batches until closed
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.changed.wait()
+                if not self.pending:
+                    return
+                batch = list(self.pending.items())
+                self.pending.clear()
+                for path, (kind, _) in batch:
+                    if kind == WRITE:
+                        self.written.add(path)
+                    else:
+                        self.written.discard(path)
+                self.busy = True
+                self.changed.notify_all()
+
+            try:
+                written = set()
+                for path, (kind, log) in batch:
+                    if kind == WRITE:
+                        written.add(self.backend.write(path, log, self.fsync == "always"))
+                        self.stats["writes"] += 1
+                    elif os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        written.add(self.backend.remove(path, self.fsync == "always"))
+                        self.stats["removes"] += 1
+                written.discard(None)
+                if self.fsync == "batch":
+                    for path in written:
+                        sync_path(path)
+                if self.fsync != "none":
+                    for dir_path in set(os.path.dirname(path) or "." for path in written):
+                        sync_path(dir_path)
+            except BaseException as error:
+                with self.lock:
+                    self.error = error
+                    self.busy = False
+                    self.pending.clear()
+                    self.changed.notify_all()
+                return
+
+            with self.lock:
+                self.busy = False
+                self.changed.notify_all()
+
+    def flush(self):
+        # Waits until every queued operation is on disk
+        with self.lock:
+            while (self.pending or self.busy) and self.error is None:
+                self.changed.wait()
+            if self.error is not None:
+                raise RuntimeError("Buffer writer failed") from self.error
+
+    def close(self, metrics=None):
+        # Flushes pending operations, stops the thread and adds the writer's counters to metrics
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.changed.notify_all()
+        self.thread.join()
+        self.backend.close(metrics)
+        if metrics is not None:
+            for name, value in self.stats.items():
+                metrics.incr("writer_" + name, value)
+        if self.error is not None:
+            raise RuntimeError("Buffer writer failed") from self.error
+
+def make_writer(params, results_path):
+    # Builds the log writer params ask for: a BufferWriter over the chosen backend if async_writer is set,
+    # the SegmentStore itself if not, and None for synchronous JSON logs
+    backend = None
+    if params["log_backend"] == "segment":
+        backend = SegmentStore(results_path, params["segment_max_mb"], params["segment_compact_ratio"])
+    elif params["log_backend"] != "json":
+        raise ValueError("Unknown log backend " + str(params["log_backend"]))
+    if params["async_writer"]:
+        return BufferWriter(params["writer_max_pending"], params["writer_fsync"], backend)
+    return backend
@@ -0,0 +1,52 @@
+import os
+import pickle
+import numpy as np
+from BufferWriter import sync_path
+
+# A SingleSBB checkpoint is two files in the results directory:
+#   checkpoint.pkl          pickled pipeline state, rewritten every checkpoint
+#   checkpoint_values.npz   precomputed values and normalized VAD scores, written once per run
+# Both are written to a temporary file, synced and renamed into place, so a crash leaves the previous checkpoint
+
+CHECKPOINT_NAME = "checkpoint.pkl"
+VALUES_NAME = "checkpoint_values.npz"
+
+def _atomic_write(path, write):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as checkpoint_out:
+        write(checkpoint_out)
+        checkpoint_out.flush()
+        os.fsync(checkpoint_out.fileno())
+    os.replace(tmp_path, path)
+    sync_path(os.path.dirname(path) or ".")
+
+def save_state(results_path, state):
+    _atomic_write(os.path.join(results_path, CHECKPOINT_NAME),
+                  lambda checkpoint_out: pickle.dump(state, checkpoint_out, protocol=pickle.HIGHEST_PROTOCOL))
+
+def save_values(results_path, vad_scores, data_values):
+    _atomic_write(os.path.join(results_path, VALUES_NAME),
+                  lambda values_out: np.savez(values_out, vad_scores=vad_scores, data_values=data_values))
+
+def has_values(results_path):
+    return os.path.exists(os.path.join(results_path, VALUES_NAME))
+
+def load_state(results_path):
+    # Returns the last checkpointed state, or None if there is none
+    checkpoint_path = os.path.join(results_path, CHECKPOINT_NAME)
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'rb') as checkpoint_in:
+        return pickle.load(checkpoint_in)
+
+def load_values(results_path):
+    # Returns the checkpointed (vad_scores, data_values)
+    with np.load(os.path.join(results_path, VALUES_NAME)) as values:
+        return values["vad_scores"], values["data_values"]
+
+def remove_checkpoint(results_path):
+    for name in (CHECKPOINT_NAME, VALUES_NAME):
+        try:
+            os.remove(os.path.join(results_path, name))
+        except FileNotFoundError:
+            pass
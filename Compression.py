@@ -0,0 +1,48 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+
+def decision_quality(decision, min_quality=5, max_quality=95):
+    # Maps LBO decisions in [0, 1] to JPEG qualities
+    return np.rint(min_quality + np.asarray(decision) * (max_quality - min_quality)).astype(int)
+
+def compress_frame(img_ptr, out_ptr, quality):
+    # Re-encodes one frame as JPEG at quality and returns the bytes written
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("Real compression needs Pillow; install it or set compression_mode to \"fake\"")
+
+    with Image.open(img_ptr) as image:
+        encoded = io.BytesIO()
+        image.convert("RGB").save(encoded, "JPEG", quality=int(quality))
+    with open(out_ptr, 'wb') as frame_out:
+        frame_out.write(encoded.getbuffer())
+    return encoded.tell()
+
+class ImageCompressor:
+    # Class for re-encoding buffer frames on a worker pool
+    # Pillow releases the GIL while encoding, so threads are usually enough
+
+    def __init__(self, workers=None, min_quality=5, max_quality=95, executor="thread"):
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        if executor == "process":
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+        elif executor == "thread":
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError("Unknown compression executor " + str(executor))
+
+    def compress(self, data_ptrs, decision, out_path):
+        # Compresses every frame into out_path and returns the compressed size of each
+        os.makedirs(out_path, exist_ok=True)
+        qualities = decision_quality(decision, self.min_quality, self.max_quality)
+        out_ptrs = [os.path.join(out_path, os.path.splitext(os.path.basename(img_ptr))[0] + ".jpg")
+                    for img_ptr in data_ptrs]
+        sizes = self.pool.map(compress_frame, data_ptrs, out_ptrs, qualities.tolist())
+        return np.fromiter(sizes, dtype=float, count=len(out_ptrs))
+
+    def close(self):
+        self.pool.shutdown()
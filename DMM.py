@@ -1,6 +1,16 @@
+import logging
+import numpy as np
 from enum import Enum
 from buffer import Buffer
 
+logger = logging.getLogger(__name__)
+
+def run_lengths(mask):
+    # Length of the run of True values starting at each position of mask
+    positions = np.arange(len(mask))
+    ends = np.append(np.flatnonzero(~mask), len(mask))
+    return ends[np.searchsorted(ends, positions)] - positions
+
 class DMM:
     # Class for SBB Mealy machine
 
@@ -11,24 +21,25 @@ class DMM:
         WAITING = 3
     
     def __init__(self, major_buffer_max=600, wait_buffer_max=30,
-                 pre_buffer_min=20, similarity_threshold=10, value_threshold=0):
+                 pre_buffer_min=20, similarity_threshold=10, value_threshold=0, metrics=None):
         self.MAJOR_BUFFER_MAX = major_buffer_max
         self.WAIT_BUFFER_MAX = wait_buffer_max
         self.SIMILARITY_THRESHOLD = similarity_threshold
         self.VALUE_THRESHOLD = value_threshold
         self.PRE_BUFFER_MIN = pre_buffer_min
         self.started = False
+        self.metrics = metrics
     
     def start(self, precursor):
         self.state = DMM.State.ACTIVE
         self.prev_state = DMM.State.ACTIVE
         self.pre_buffer = precursor
-        self.major_buffer = Buffer()
-        self.wait_buffer = Buffer()
+        self.major_buffer = Buffer(capacity=self.MAJOR_BUFFER_MAX)
+        self.wait_buffer = Buffer(capacity=self.WAIT_BUFFER_MAX + self.PRE_BUFFER_MIN)
         self.started = True
 
         input = 2 if precursor.maxValue() > self.VALUE_THRESHOLD else 1
-        print("DMM input: " + str(input))
+        logger.debug("DMM input: %d", input)
         action = self.update_state(input)
         if action == 1 or action == 2:
             self.run_action(None, action)
@@ -55,7 +66,7 @@ class DMM:
             else:
                 input = 2
         
-        print("DMM input: " + str(input))
+        logger.debug("DMM input: %d", input)
         return input
 
     def update_state(self, input):
@@ -111,8 +122,10 @@ class DMM:
         else:
             raise ValueError("Inappropriate DMM state " + DMM.State(self.state).name)
         
-        print("DMM new state: " + DMM.State(self.state).name)
-        print("DMM action number: " + str(action))
+        logger.debug("DMM new state: %s", self.state.name)
+        logger.debug("DMM action number: %d", action)
+        if self.metrics is not None:
+            self.metrics.incr("dmm_transitions", action=action)
         return action
 
     def run_action(self, next_frame, action):
@@ -156,6 +169,31 @@ class DMM:
 
         return frame_resolved
 
+    def run_length(self, low_run, buffering_run):
+        # Number of upcoming frames the machine takes through the same self-transition,
+        # given the lengths of the runs of low-value frames and of frames that keep it buffering starting at the next frame
+        # Returns (frames, action)
+        # WAITING keeps waiting on low-value frames until the wait buffer fills, and similarity is never used there
+        # BUFFERING keeps buffering on high-value frames, or low-value frames similar to the major buffer,
+        # until the major buffer fills
+        if self.state == DMM.State.WAITING:
+            return min(low_run, self.WAIT_BUFFER_MAX - self.wait_buffer.size()), 5
+        if self.state == DMM.State.BUFFERING:
+            return min(buffering_run, self.MAJOR_BUFFER_MAX - self.major_buffer.size()), 3
+        return 0, None
+
+    def run_bulk(self, action, index, value, cost, anomaly_score, data_ptrs, track_ids):
+        # Runs self-transition action 3 or 5 for a run of frames given as columns
+        if action == 3:
+            self.major_buffer.appendBlock(index, value, cost, anomaly_score, data_ptrs, track_ids)
+        elif action == 5:
+            self.wait_buffer.appendBlock(index, value, cost, anomaly_score, data_ptrs, track_ids)
+        else:
+            raise ValueError("DMM action number " + str(action) + " can't be run in bulk")
+        self.prev_state = self.state
+        if self.metrics is not None:
+            self.metrics.incr("dmm_transitions", len(index), action=action)
+
     def reset(self, next_frame):
         # Resets DMM after a terminate
         # Returns initial input given previous state
@@ -173,8 +211,8 @@ class DMM:
 
         self.state = DMM.State.ACTIVE
         self.prev_state = DMM.State.ACTIVE
-        self.major_buffer = Buffer()
-        self.wait_buffer = Buffer()
+        self.major_buffer = Buffer(capacity=self.MAJOR_BUFFER_MAX)
+        self.wait_buffer = Buffer(capacity=self.WAIT_BUFFER_MAX + self.PRE_BUFFER_MIN)
 
-        print("DMM input: " + str(input))
+        logger.debug("DMM input: %d", input)
         return input
\ No newline at end of file
@@ -2,10 +2,11 @@ import os
 
 class DataFrame:
 
-    def __init__(self, img_ptr, index, value, anomaly_score, track_ids):
+    def __init__(self, img_ptr, index, value, anomaly_score, track_ids, cost=None):
         self.data_ptr = img_ptr
         self.index = index
         self.value = value
         self.anomaly_score = anomaly_score
-        self.cost = os.path.getsize(img_ptr)
+        # Size on disk, taken from the frame manifest when given
+        self.cost = cost if cost is not None else os.path.getsize(img_ptr)
         self.objects = track_ids
\ No newline at end of file
@@ -0,0 +1,111 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from FrameManifest import FrameManifest, save_cache
+from TrackIndex import popcount
+
+HASHES_SUFFIX = ".sbb_hashes.npz"
+
+# Each hash compares neighbouring pixels of a HASH_SIZE+1 by HASH_SIZE grayscale thumbnail, one bit per pair
+HASH_SIZE = 8
+
+# Frames compared against a run's first frame at once before the chunk doubles
+RUN_CHUNK = 16
+
+def frame_hash(img_ptr):
+    # Difference hash of one frame as an int, or None if the frame isn't a readable image
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("Frame deduplication needs Pillow; install it or set dedup to 0")
+
+    try:
+        with Image.open(img_ptr) as image:
+            # JPEG frames are decoded straight at a reduced scale
+            image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+            pixels = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    except (OSError, ValueError):
+        return None
+    bits = (pixels[:,1:] > pixels[:,:-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+def hash_distance(hashes, other):
+    # Number of differing bits between each hash and other
+    return popcount(np.bitwise_xor(hashes, np.uint64(other)))
+
+class FrameHashes:
+    # Class for the perceptual hashes of every frame in a frame directory
+    # Computed on a thread pool and cached beside the directory, keyed by the directory's mtime like its manifest
+
+    def __init__(self, frame_path, hashes, valid, mtime_ns):
+        self.frame_path = frame_path
+        self.hashes = hashes
+        # Frames that couldn't be read as images have no hash and are never duplicates
+        self.valid = valid
+        self.mtime_ns = mtime_ns
+
+    @staticmethod
+    def cachePath(frame_path):
+        return os.path.normpath(frame_path) + HASHES_SUFFIX
+
+    @classmethod
+    def build(cls, manifest, workers=None):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            frame_hashes = list(pool.map(frame_hash, manifest.paths()))
+        valid = np.array([frame_hash is not None for frame_hash in frame_hashes], dtype=bool)
+        hashes = np.array([frame_hash or 0 for frame_hash in frame_hashes], dtype=np.uint64)
+        return cls(manifest.frame_path, hashes, valid, manifest.mtime_ns)
+
+    @classmethod
+    def load(cls, manifest, workers=None, cache=True):
+        # Loads the cached hashes if they were computed for this manifest, else computes them
+        if cache:
+            try:
+                with np.load(cls.cachePath(manifest.frame_path)) as cached:
+                    if int(cached["mtime_ns"]) == manifest.mtime_ns and len(cached["hashes"]) == len(manifest):
+                        return cls(manifest.frame_path, cached["hashes"], cached["valid"], manifest.mtime_ns)
+            except (OSError, KeyError, ValueError):
+                pass
+
+        frame_hashes = cls.build(manifest, workers)
+        if cache:
+            frame_hashes.save()
+        return frame_hashes
+
+    def save(self):
+        save_cache(FrameHashes.cachePath(self.frame_path), hashes=self.hashes, valid=self.valid,
+                   mtime_ns=np.int64(self.mtime_ns))
+
+    def runs(self, index, max_distance):
+        # Start of each run of the frames index, given in order, that are within max_distance bits of the run's first
+        # frame, as positions in index
+        # Each run is extended in chunks that double while every frame is close, so a buffer is scanned in linear time
+        hashes = self.hashes[index]
+        valid = self.valid[index]
+        n = len(index)
+        starts = []
+        position = 0
+        while position < n:
+            starts.append(position)
+            end = position + 1
+            if valid[position]:
+                # The run goes on while frames stay valid and close to its first frame
+                chunk = RUN_CHUNK
+                while end < n:
+                    stop = min(end + chunk, n)
+                    close = valid[end:stop] & (hash_distance(hashes[end:stop], hashes[position]) <= max_distance)
+                    if not close.all():
+                        end += int(np.argmin(close))
+                        break
+                    end = stop
+                    chunk *= 2
+            position = end
+        return np.array(starts, dtype=np.int64)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Error! Usage is: python3 FrameHash.py <directory of images>")
+        exit()
+    frame_hashes = FrameHashes.load(FrameManifest.load(sys.argv[1]))
+    print("Hashed %d of %d frames" % (np.count_nonzero(frame_hashes.valid), len(frame_hashes.valid)))
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import numpy as np
+
+MANIFEST_SUFFIX = ".sbb_manifest.npz"
+
+def save_cache(cache_path, **arrays):
+    # Writes arrays to an .npz cache atomically, skipping it if the location isn't writable
+    # The temporary file is unique, so runs writing the same cache at once don't write over each other
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(cache_path) + ".", suffix=".tmp",
+                                        dir=os.path.dirname(cache_path) or ".")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as cache_out:
+            np.savez(cache_out, **arrays)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+class FrameManifest:
+    # Class for the sorted frame names and sizes of a frame directory
+    # Built with a single scandir pass and cached beside the directory, keyed by the directory's mtime
+
+    def __init__(self, frame_path, names, sizes, mtime_ns):
+        self.frame_path = frame_path
+        self.names = names
+        self.sizes = sizes
+        self.mtime_ns = mtime_ns
+
+    @staticmethod
+    def cachePath(frame_path):
+        # The cache sits next to the directory so writing it doesn't change the directory's mtime
+        return os.path.normpath(frame_path) + MANIFEST_SUFFIX
+
+    @classmethod
+    def build(cls, frame_path):
+        # Lists and sizes every frame in one directory pass
+        mtime_ns = os.stat(frame_path).st_mtime_ns
+        entries = []
+        with os.scandir(frame_path) as it:
+            for entry in it:
+                if entry.is_file():
+                    entries.append((entry.name, entry.stat().st_size))
+        entries.sort()
+        names = np.array([name for name, _ in entries], dtype=str)
+        sizes = np.array([size for _, size in entries], dtype=np.int64)
+        return cls(frame_path, names, sizes, mtime_ns)
+
+    @classmethod
+    def load(cls, frame_path, cache=True):
+        # Loads the cached manifest if the directory hasn't changed since it was built, else rebuilds it
+        if cache:
+            try:
+                mtime_ns = os.stat(frame_path).st_mtime_ns
+                with np.load(cls.cachePath(frame_path)) as cached:
+                    if int(cached["mtime_ns"]) == mtime_ns:
+                        return cls(frame_path, cached["names"], cached["sizes"], mtime_ns)
+            except (OSError, KeyError, ValueError):
+                pass
+
+        manifest = cls.build(frame_path)
+        if cache:
+            manifest.save()
+        return manifest
+
+    def save(self):
+        save_cache(FrameManifest.cachePath(self.frame_path), names=self.names, sizes=self.sizes,
+                   mtime_ns=np.int64(self.mtime_ns))
+
+    def path(self, i):
+        return os.path.join(self.frame_path, self.names[i])
+
+    def paths(self):
+        return [os.path.join(self.frame_path, name) for name in self.names]
+
+    def __len__(self):
+        return len(self.names)
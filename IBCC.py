@@ -1,6 +1,16 @@
+import sys
+import json
+import time
+import argparse
 import numpy as np
 from scipy.special import psi
 
+def ibcc_probs(vad_scores, oad_scores):
+    # Normal and anomaly class probabilities given by each classifier, from normalized VAD scores
+    # and OAD scores whose first column is the background class
+    vad_probs = np.stack([1-vad_scores, vad_scores], axis=1)
+    oad_probs = np.stack([oad_scores[:,0], 1-oad_scores[:,0]], axis=1)
+    return vad_probs, oad_probs
 
 class IBCC:
     # Class for performing Independent Bayesian Classifier Combination
@@ -13,9 +23,9 @@ class IBCC:
         @param dict confusion_prior_init: initial Dirichlet priors for the confusion matrix of each classifier
         @param list class_prob_prior_init: initial Dirichlet prior for class probabilities
         """
-        self.confusion_prior_init = confusion_prior_init
-        for classifier in self.confusion_prior_init:
-            self.confusion_prior_init[classifier] = np.array(self.confusion_prior_init[classifier]).astype(float)
+        self.confusion_prior_init = {}
+        for classifier, confusion_prior in confusion_prior_init.items():
+            self.confusion_prior_init[classifier] = np.array(confusion_prior).astype(float)
         self.class_prob_prior_init = np.array(class_prob_prior_init).astype(float)
         self.num_classes = len(class_prob_prior_init)
 
@@ -46,7 +56,7 @@ class IBCC:
         ln_confusion = self.ln_confusion_init
         ln_class_prob = self.ln_class_prob_init
 
-        anomaly_scores = anomaly_scores_in
+        anomaly_scores = {}
         for classifier in anomaly_scores_in:
             anomaly_scores[classifier] = np.array(anomaly_scores_in[classifier]).astype(float)
 
@@ -69,6 +79,150 @@ class IBCC:
         # print("IBCC converged after " + str(iterations) + " iterations")
         return ev
 
+    def inferVB_batch(self, vad_scores, oad_scores):
+        """
+        Runs Variational Bayes inference for many frames at once, giving the same per-frame results as inferVB
+
+        @param ndarray vad_scores: (N, classes) probability of normal and anomaly classes given by VAD for each frame
+        @param ndarray oad_scores: (N, classes) probability of normal and anomaly classes given by OAD for each frame
+        @return ndarray ev: (N, classes) expected value estimate for each class of each frame
+        """
+        return self._inferVBBatch({"VAD": vad_scores, "OAD": oad_scores})
+
+    def _inferVBBatch(self, anomaly_scores_in):
+        """
+        Runs independent Variational Bayes inference on every frame, dropping frames from the update once they converge
+
+        @param dict anomaly_scores_in: (N, classes) probability of normal and anomaly classes given by each classifier
+        @return ndarray ev: (N, classes) expected value estimate for each class of each frame
+        """
+        anomaly_scores = {}
+        for classifier in anomaly_scores_in:
+            anomaly_scores[classifier] = np.array(anomaly_scores_in[classifier]).astype(float)
+        num_frames = len(next(iter(anomaly_scores.values())))
+
+        # Initialize parameters for every frame
+        result = np.empty((num_frames, self.num_classes))
+        active = np.arange(num_frames)
+        ev = np.tile(self.ev_init, (num_frames, 1))
+        ln_class_prob = np.tile(self.ln_class_prob_init, (num_frames, 1))
+        ln_confusion = {}
+        for classifier, confusion in self.ln_confusion_init.items():
+            ln_confusion[classifier] = np.broadcast_to(confusion, (num_frames,) + confusion.shape)
+
+        iterations = 0
+        while iterations < self.max_iterations and active.size > 0:
+            prev_ev = ev
+            ev = self._updateEVBatch(ln_confusion, ln_class_prob, anomaly_scores)
+            ln_class_prob = self._updateLnClassProbBatch(ev)
+            ln_confusion = self._updateLnConfusionBatch(anomaly_scores, ev)
+
+            # Check convergence per frame and retire converged frames
+            if iterations % self.convergence_check_freq == 0:
+                converged = np.max(np.abs(ev - prev_ev), axis=1) < self.convergence_threshold
+                if np.any(converged):
+                    result[active[converged]] = ev[converged]
+                    remaining = ~converged
+                    active = active[remaining]
+                    ev = ev[remaining]
+                    ln_class_prob = ln_class_prob[remaining]
+                    for classifier in anomaly_scores:
+                        anomaly_scores[classifier] = anomaly_scores[classifier][remaining]
+                    for classifier in ln_confusion:
+                        ln_confusion[classifier] = ln_confusion[classifier][remaining]
+
+            iterations += 1
+
+        # Frames that hit max_iterations keep their last estimate
+        result[active] = ev
+        return result
+
+    def trainVB(self, vad_scores, oad_scores):
+        """
+        Runs Variational Bayes over all frames jointly, learning one confusion matrix per classifier
+        and one class distribution from the evidence of the whole recording
+
+        @param ndarray vad_scores: (N, classes) probability of normal and anomaly classes given by VAD for each frame
+        @param ndarray oad_scores: (N, classes) probability of normal and anomaly classes given by OAD for each frame
+        @return dict confusion_prior: learned Dirichlet priors for the confusion matrix of each classifier
+        @return ndarray class_prob_prior: learned Dirichlet prior for class probabilities
+        @return int iterations: number of iterations run
+        """
+        return self._trainVB({"VAD": vad_scores, "OAD": oad_scores})
+
+    def _trainVB(self, anomaly_scores_in, block_size=16384):
+        """
+        Alternates an E-step over every frame's class estimate with M-step updates of the pooled Dirichlet priors,
+        starting from the initial priors, until no frame's estimate changes by more than the convergence threshold
+        Frames are kept along the last axis and each iteration runs over blocks of block_size frames that stay in cache,
+        updating their estimates and adding up the pooled evidence in one pass
+
+        @param dict anomaly_scores_in: (N, classes) probability of normal and anomaly classes given by each classifier
+        @param int block_size: frames per block
+        @return dict confusion_prior: learned Dirichlet priors for the confusion matrix of each classifier
+        @return ndarray class_prob_prior: learned Dirichlet prior for class probabilities
+        @return int iterations: number of iterations run
+        """
+        classifiers = list(self.confusion_prior_init)
+        # (classifiers * classes, N) stacked classifier outputs
+        scores = np.concatenate([np.asarray(anomaly_scores_in[classifier], dtype=float).T
+                                 for classifier in classifiers])
+        num_frames = scores.shape[1]
+
+        confusion_prior = self.confusion_prior_init
+        class_prob_prior = self.class_prob_prior_init
+        ln_confusion = self.ln_confusion_init
+        ln_class_prob = self.ln_class_prob_init
+        ev = np.tile(self.ev_init[:,None], (1, num_frames))
+
+        iterations = 0
+        while iterations < self.max_iterations:
+            ln_confusion_stacked = np.concatenate([ln_confusion[classifier] for classifier in classifiers], axis=1)
+            class_counts = np.zeros(self.num_classes)
+            confusion_counts = np.zeros((self.num_classes, len(scores)))
+            ev_delta = 0.0
+            for start in range(0, num_frames, block_size):
+                block_scores = scores[:,start:start+block_size]
+                block_ev = self._updateEVPooled(ln_confusion_stacked, ln_class_prob, block_scores)
+                ev_delta = max(ev_delta, np.max(np.abs(block_ev - ev[:,start:start+block_size]), initial=0.0))
+                ev[:,start:start+block_size] = block_ev
+                class_counts += np.sum(block_ev, axis=1)
+                confusion_counts += block_ev @ block_scores.T
+
+            class_prob_prior = self.class_prob_prior_init + class_counts
+            ln_class_prob = psi(class_prob_prior) - psi(np.sum(class_prob_prior))
+            confusion_prior = {}
+            ln_confusion = {}
+            for classifier, counts in zip(classifiers, np.split(confusion_counts, len(classifiers), axis=1)):
+                confusion_prior[classifier] = self.confusion_prior_init[classifier] + counts
+                ln_confusion[classifier] = psi(confusion_prior[classifier]) - \
+                    psi(np.sum(confusion_prior[classifier], axis=1))[:,None]
+
+            # Check convergence, skipping the first iteration's change from the initial estimate
+            if iterations > 0 and iterations % self.convergence_check_freq == 0:
+                if ev_delta < self.convergence_threshold:
+                    break
+
+            iterations += 1
+
+        return confusion_prior, class_prob_prior, iterations
+
+    def _updateEVPooled(self, ln_confusion, ln_class_prob, scores):
+        """
+        Updates the expected value estimate of each class for a block of frames from the pooled estimates
+
+        @param ndarray ln_confusion: (classes, classifiers * classes) current log confusion matrix estimates, stacked
+        @param ndarray ln_class_prob: (classes,) current log class probabilities estimate
+        @param ndarray scores: (classifiers * classes, N) probability of each class given by each classifier, stacked
+        @return ndarray ev: (classes, N) updated expected value estimate for each class of each frame
+        """
+        ln_joint = ln_confusion @ scores
+        ln_joint += ln_class_prob[:,None]
+        # Shift each frame's log joint to at most zero so exp can't overflow
+        ln_joint -= np.max(ln_joint, axis=0)
+        joint = np.exp(ln_joint, out=ln_joint)
+        joint /= np.sum(joint, axis=0)
+        return joint
 
     def _updateLnClassProb(self, ev):
         """
@@ -79,9 +233,7 @@ class IBCC:
         @return updated_class_prob_prior: updated Dirichlet prior for class probabilities
         """
         # Update class probability priors
-        updated_class_prob_prior = self.class_prob_prior_init
-        for i in range(self.num_classes):
-            updated_class_prob_prior[i] += ev[i]
+        updated_class_prob_prior = self.class_prob_prior_init + ev
 
         # Update log class probabilities
         updated_ln_class_prob = psi(updated_class_prob_prior) - psi(np.sum(updated_class_prob_prior))
@@ -98,10 +250,9 @@ class IBCC:
         @return dict updated_confusion_prior: updated Dirichlet priors for the confusion matrix of each classifier
         """
         # Update confusion priors
-        updated_confusion_prior = self.confusion_prior_init
-        for classifier in updated_confusion_prior:
-            for i in range(self.num_classes):
-                updated_confusion_prior[classifier][i,:] += anomaly_scores[classifier] * ev[i]
+        updated_confusion_prior = {}
+        for classifier, confusion_prior_init in self.confusion_prior_init.items():
+            updated_confusion_prior[classifier] = confusion_prior_init + np.outer(ev, anomaly_scores[classifier])
 
         # Update log confusion
         updated_ln_confusion = {}
@@ -142,4 +293,79 @@ class IBCC:
             ln_joint[i] = ln_class_prob[i]
             for classifier, confusion in ln_confusion.items():
                 ln_joint[i] += np.sum(np.multiply(anomaly_scores[classifier], confusion[i,:]))
-        return ln_joint
\ No newline at end of file
+        return ln_joint
+
+    def _updateLnClassProbBatch(self, ev):
+        """
+        Updates the log class probabilities of each frame
+
+        @param ndarray ev: (N, classes) current expected value estimate for each class of each frame
+        @return ndarray updated_ln_class_prob: (N, classes) updated log class probabilities estimate
+        """
+        updated_class_prob_prior = self.class_prob_prior_init + ev
+        return psi(updated_class_prob_prior) - psi(np.sum(updated_class_prob_prior, axis=1))[:,None]
+
+    def _updateLnConfusionBatch(self, anomaly_scores, ev):
+        """
+        Updates the log confusion matrix estimate of each frame for each classifier
+
+        @param dict anomaly_scores: (N, classes) probability of normal and anomaly classes given by each classifier
+        @param ndarray ev: (N, classes) current expected value estimate for each class of each frame
+        @return dict updated_ln_confusion: (N, classes, classes) updated log confusion matrix estimate for each classifier
+        """
+        updated_ln_confusion = {}
+        for classifier, confusion_prior_init in self.confusion_prior_init.items():
+            confusion_prior = confusion_prior_init + ev[:,:,None] * anomaly_scores[classifier][:,None,:]
+            updated_ln_confusion[classifier] = psi(confusion_prior) - psi(np.sum(confusion_prior, axis=2))[:,:,None]
+        return updated_ln_confusion
+
+    def _updateEVBatch(self, ln_confusion, ln_class_prob, anomaly_scores):
+        """
+        Updates the expected value estimate of each class for each frame
+
+        @param dict ln_confusion: (N, classes, classes) current log confusion matrix estimate for each classifier
+        @param ndarray ln_class_prob: (N, classes) current log class probabilities estimate
+        @param dict anomaly_scores: (N, classes) probability of normal and anomaly classes given by each classifier
+        @return ndarray ev: (N, classes) updated expected value estimate for each class of each frame
+        """
+        ln_joint = np.array(ln_class_prob)
+        for classifier, confusion in ln_confusion.items():
+            ln_joint += np.sum(anomaly_scores[classifier][:,None,:] * confusion, axis=2)
+        joint = np.exp(ln_joint)
+        return joint / np.sum(joint, axis=1)[:,None]
+
+def main(argv):
+    # ValueEngine builds on IBCC, so it's imported here rather than at the top
+    from ValueEngine import normalize_vad
+
+    parser = argparse.ArgumentParser(description="Learn IBCC priors from a recording's VAD and OAD scores")
+    parser.add_argument("vad_scores")
+    parser.add_argument("oad_scores")
+    parser.add_argument("--params", default="params.json", help="parameters holding the initial priors")
+    parser.add_argument("--output", help="parameters file to write the learned priors to, --params by default")
+    parser.add_argument("--prior-weight", type=float, default=1.0,
+                        help="scale of the initial priors, lower to let the recording outweigh them")
+    args = parser.parse_args(argv)
+    if args.prior_weight <= 0:
+        parser.error("--prior-weight must be positive")
+
+    params = json.load(open(args.params))
+    vad_scores = normalize_vad(np.load(args.vad_scores, mmap_mode="r"))
+    oad_scores = np.load(args.oad_scores, mmap_mode="r")
+    confusion_prior_init = {classifier: np.array(confusion_prior, dtype=float) * args.prior_weight
+                            for classifier, confusion_prior in params["confusion_prior_init"].items()}
+    ibcc = IBCC(confusion_prior_init, np.array(params["class_prob_prior_init"], dtype=float) * args.prior_weight)
+
+    start = time.perf_counter()
+    confusion_prior, class_prob_prior, iterations = ibcc.trainVB(*ibcc_probs(vad_scores, oad_scores))
+    print("IBCC converged after %d iterations in %.2f s on %d frames" %
+          (iterations, time.perf_counter() - start, len(vad_scores)))
+
+    params["confusion_prior_init"] = {classifier: confusion.tolist() for classifier, confusion in confusion_prior.items()}
+    params["class_prob_prior_init"] = class_prob_prior.tolist()
+    with open(args.output or args.params, 'w') as params_out:
+        json.dump(params, params_out, indent=4)
+        params_out.write("\n")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
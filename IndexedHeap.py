@@ -0,0 +1,79 @@
+class IndexedHeap:
+    # Class for a binary min-heap of keys that can remove or re-prioritize any key in O(log n)
+    # Ties in priority are broken by key, so order never depends on insertion history
+
+    def __init__(self):
+        self.heap = []
+        self.priority = {}
+        self.position = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, key):
+        return key in self.position
+
+    def _less(self, i, j):
+        key_i, key_j = self.heap[i], self.heap[j]
+        return (self.priority[key_i], key_i) < (self.priority[key_j], key_j)
+
+    def _swap(self, i, j):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.position[self.heap[i]] = i
+        self.position[self.heap[j]] = j
+
+    def _siftUp(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if not self._less(i, parent):
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _siftDown(self, i):
+        n = len(self.heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and self._less(child, smallest):
+                    smallest = child
+            if smallest == i:
+                break
+            self._swap(i, smallest)
+            i = smallest
+
+    def push(self, key, priority):
+        if key in self.position:
+            raise KeyError("Key " + str(key) + " is already queued")
+        self.priority[key] = priority
+        self.position[key] = len(self.heap)
+        self.heap.append(key)
+        self._siftUp(len(self.heap) - 1)
+
+    def peek(self):
+        # Returns the (key, priority) with the lowest priority without removing it
+        key = self.heap[0]
+        return key, self.priority[key]
+
+    def pop(self):
+        key = self.heap[0]
+        return key, self.remove(key)
+
+    def remove(self, key):
+        # Removes key from anywhere in the heap and returns its priority
+        i = self.position.pop(key)
+        priority = self.priority.pop(key)
+        last = self.heap.pop()
+        if i < len(self.heap):
+            self.heap[i] = last
+            self.position[last] = i
+            self._siftDown(i)
+            self._siftUp(self.position[last])
+        return priority
+
+    def update(self, key, priority):
+        # Changes the priority of a queued key
+        self.priority[key] = priority
+        i = self.position[key]
+        self._siftUp(i)
+        self._siftDown(self.position[key])
@@ -1,15 +1,101 @@
 import numpy as np
 
-def single_optimize(size,value,eta,zeta):
-    a = 0.1083869
-    b = 0.99837249
-    c = 0.02535
+class LogRateModel:
+    # Compression model phi(d) = -a*log2(1 - b*d) + c
+    # Maps an LBO decision d in [0, 1] to the fraction of a frame's original size kept after compression
 
+    def __init__(self, a=0.1083869, b=0.99837249, c=0.02535):
+        self.a = a
+        self.b = b
+        self.c = c
+
+    def phi(self, decision):
+        return -self.a*np.log2(1 - self.b*np.asarray(decision)) + self.c
+
+    def optimalDecision(self, value, ratio):
+        # Unclipped decision maximizing ratio*value*d - phi(d), where ratio is zeta/eta
+        return -self.a/(np.log(2)*ratio*value) + 1/self.b
+
+# Rate models selectable by params["rate_model"]
+RATE_MODELS = {
+    "log": LogRateModel,
+}
+
+DEFAULT_RATE_MODEL = LogRateModel()
+
+# Ways of choosing decisions selectable by params["lbo_mode"]: "ratio" trades value against size at a fixed zeta/eta
+# per frame, "budget" maximizes a buffer's retained value within lbo_budget_mb of estimated compressed size
+LBO_MODES = ("ratio", "budget")
+
+def lbo_budget(params):
+    # Byte budget per buffer in budget mode, None in ratio mode
+    if params["lbo_mode"] == "ratio":
+        return None
+    if params["lbo_mode"] == "budget":
+        return params["lbo_budget_mb"] * 1024 * 1024
+    raise ValueError("Unknown LBO mode " + str(params["lbo_mode"]))
+
+def get_rate_model(name):
+    if name not in RATE_MODELS:
+        raise ValueError("Unknown rate model " + str(name))
+    return RATE_MODELS[name]()
+
+def single_optimize(size,value,eta,zeta,model=DEFAULT_RATE_MODEL):
     if value == 0.0:
         return 0
-    action = -a/(np.log(2)*(zeta/eta)*value) + 1/b
+    action = model.optimalDecision(value, zeta/eta)
     if action <=0 :
         action = 0
     elif action >= 1:
         action = 1
     return action
+
+def optimize_batch(cost,value,eta,zeta,model=DEFAULT_RATE_MODEL):
+    # Array version of single_optimize over every frame of a buffer
+    value = np.asarray(value, dtype=float)
+    decision = np.zeros(value.shape)
+    nonzero = value != 0.0
+    decision[nonzero] = model.optimalDecision(value[nonzero], zeta/eta)
+    return np.clip(decision, 0, 1)
+
+def optimize_budget(cost,value,budget,model=DEFAULT_RATE_MODEL,points=64,tolerance=1e-6):
+    # Decisions maximizing the buffer's total value*decision with its total cost*phi(decision) within budget
+    # For a Lagrange multiplier lam, each frame's best decision is the one maximizing value*d - lam*cost*phi(d),
+    # which is optimalDecision with ratio 1/(lam*cost). Total cost falls as lam grows, so lam is bracketed by
+    # evaluating the cost at points multipliers at once and narrowing to the pair around the budget,
+    # and the decisions of the upper end are returned so the budget is met
+    # Returns None if the budget is infeasible, with even all-zero decisions costing more than it
+    cost = np.asarray(cost, dtype=float)
+    value = np.asarray(value, dtype=float)
+    positive = value > 0.0
+
+    def decide(lam):
+        # (len(lam), frames) decisions for each multiplier in lam
+        with np.errstate(divide="ignore"):
+            ratio = 1 / (lam[:,None] * cost)
+            decision = model.optimalDecision(np.where(positive, value, 1.0), ratio)
+        return np.where(positive, np.clip(decision, 0, 1), 0.0)
+
+    def total_cost(decision):
+        return np.sum(cost * model.phi(decision), axis=-1)
+
+    keep_all = np.where(positive, 1.0, 0.0)
+    if total_cost(keep_all) <= budget:
+        return keep_all
+    keep_none = np.zeros(len(value))
+    if total_cost(keep_none) > budget:
+        return None
+    if not np.any(positive) or total_cost(keep_none) == budget:
+        return keep_none
+
+    # Multipliers worth value per byte bracket every frame's switch from keeping everything to keeping nothing
+    value_per_byte = value[positive & (cost > 0)] / cost[positive & (cost > 0)]
+    lo = np.log(np.min(value_per_byte)) - 30
+    hi = np.log(np.max(value_per_byte)) + 30
+    while hi - lo > tolerance:
+        ln_lam = np.linspace(lo, hi, points)
+        feasible = total_cost(decide(np.exp(ln_lam))) <= budget
+        # First multiplier meeting the budget, keeping the last one as it always does
+        first = min(int(np.argmax(feasible)), points - 1) if np.any(feasible) else points - 1
+        lo, hi = ln_lam[max(first - 1, 0)], ln_lam[first]
+    return decide(np.exp(np.array([hi])))[0]
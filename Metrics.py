@@ -0,0 +1,127 @@
+import json
+import time
+import bisect
+from contextlib import contextmanager
+
+# Upper bounds of histogram buckets, in seconds for latencies
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Metrics:
+    # Class for run counters, gauges, histograms and cumulative stage timers
+    # Exported as JSON or Prometheus text at the end of a run
+
+    def __init__(self, prefix="sbb"):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        # Per-bucket counts, with a last bucket for values above every bound, and the sum of observed values
+        self.histograms = {}
+        self.timers = {}
+        self.timer_counts = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+    def incr(self, name, amount=1, **labels):
+        key = Metrics._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def setGauge(self, name, value, **labels):
+        self.gauges[Metrics._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        # Adds value to histogram name, bucketed by LATENCY_BUCKETS
+        key = Metrics._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = {"counts": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0}
+        histogram["counts"][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram["sum"] += value
+
+    def addTime(self, name, seconds, count=1):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+        self.timer_counts[name] = self.timer_counts.get(name, 0) + count
+
+    def merge(self, other):
+        # Adds another run's counters and timers into this one, e.g. from a worker process
+        for key, value in other.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, value in other.gauges.items():
+            self.gauges.setdefault(key, value)
+        for key, histogram in other.histograms.items():
+            merged = self.histograms.setdefault(key, {"counts": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0})
+            merged["counts"] = [count + other_count for count, other_count in zip(merged["counts"], histogram["counts"])]
+            merged["sum"] += histogram["sum"]
+        for name, seconds in other.timers.items():
+            self.addTime(name, seconds, other.timer_counts[name])
+
+    @contextmanager
+    def timer(self, name):
+        # Adds the wall time of the enclosed block to timer name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start)
+
+    def toDict(self):
+        def entries(values):
+            return [{"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(values.items())]
+        return {"counters": entries(self.counters),
+                "gauges": entries(self.gauges),
+                "histograms": [{"name": name, "labels": dict(labels), "buckets": list(LATENCY_BUCKETS) + ["+Inf"],
+                                "counts": histogram["counts"], "sum": histogram["sum"],
+                                "count": sum(histogram["counts"])}
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+                "timers": [{"name": name, "seconds": seconds, "count": self.timer_counts[name]}
+                           for name, seconds in sorted(self.timers.items())]}
+
+    def toJSON(self):
+        return json.dumps(self.toDict(), indent=4)
+
+    def toPrometheus(self):
+        # Prometheus text exposition format
+        lines = []
+        def add(name, labels, value):
+            label_text = ",".join('{}="{}"'.format(label, label_value) for label, label_value in labels)
+            lines.append("{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+
+        for values, metric_type, suffix in ((self.counters, "counter", "_total"), (self.gauges, "gauge", "")):
+            declared = set()
+            for (name, labels), value in sorted(values.items()):
+                full_name = self.prefix + "_" + name + suffix
+                if full_name not in declared:
+                    lines.append("# TYPE {} {}".format(full_name, metric_type))
+                    declared.add(full_name)
+                add(full_name, labels, value)
+
+        declared = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            full_name = self.prefix + "_" + name
+            if full_name not in declared:
+                lines.append("# TYPE {} histogram".format(full_name))
+                declared.add(full_name)
+            # Bucket counts are cumulative in the exposition format
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram["counts"]):
+                cumulative += count
+                add(full_name + "_bucket", labels + (("le", str(bound)),), cumulative)
+            add(full_name + "_sum", labels, histogram["sum"])
+            add(full_name + "_count", labels, cumulative)
+
+        if self.timers:
+            lines.append("# TYPE {}_stage_seconds_total counter".format(self.prefix))
+            for name, seconds in sorted(self.timers.items()):
+                add(self.prefix + "_stage_seconds_total", (("stage", name),), seconds)
+            lines.append("# TYPE {}_stage_calls_total counter".format(self.prefix))
+            for name, count in sorted(self.timer_counts.items()):
+                add(self.prefix + "_stage_calls_total", (("stage", name),), count)
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        # Writes Prometheus text for .prom/.txt paths and JSON otherwise
+        text = self.toPrometheus() if path.endswith((".prom", ".txt")) else self.toJSON()
+        with open(path, 'w') as metrics_out:
+            metrics_out.write(text)
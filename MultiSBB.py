@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import queue as queue_module
+import traceback
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from PriorityQueue import PriorityQ, get_eviction_policy
+from Metrics import Metrics
+from LBO import get_rate_model
+from BufferWriter import make_writer
+from sbb import SingleSBB, RESULTS_PATH, reset_results_dir
+from Params import load_params, with_defaults
+
+logger = logging.getLogger(__name__)
+
+# Messages sent from camera workers to the arbiter
+BUFFER = 0
+DONE = 1
+FAILED = 2
+
+# Seconds the arbiter waits for a message before checking whether a camera process died
+ARBITER_POLL_INTERVAL = 1.0
+
+class CameraSink:
+    # Stands in for a camera's PriorityQ, forwarding finalized buffers to the arbiter
+
+    def __init__(self, camera, queue):
+        self.camera = camera
+        self.queue = queue
+
+    def fakePush(self, buffer, path):
+        self.queue.put((self.camera, BUFFER, buffer))
+
+def run_camera(camera, paths, params, results_path, queue):
+    # Runs one camera's DMM pipeline in a worker process
+    # Its buffers are logged by the arbiter, so the worker needs no log writer of its own,
+    # and the multi-camera runner doesn't resume, so it writes no checkpoints
+    params = dict(params, async_writer=0, log_backend="json", checkpoint_interval=0)
+    try:
+        sbb = SingleSBB(paths["frames"], paths["vad"], paths["oad"], paths["tracking"],
+                        params=params, results_path=results_path)
+        sbb.priorityq = CameraSink(camera, queue)
+        sbb.run()
+        queue.put((camera, DONE, sbb.metrics))
+    except Exception:
+        queue.put((camera, FAILED, traceback.format_exc()))
+
+class MultiSBB:
+    # Class for running one SBB pipeline per camera with a single storage budget
+    # Cameras run in a process pool and one arbitrating PriorityQ applies inflation and eviction across all of them
+
+    def __init__(self, cameras, params=None, results_path=RESULTS_PATH, workers=None, max_pending=16):
+        """
+        @param dict cameras: paths for each camera, with "frames", "vad", "oad" and "tracking" keys
+        @param dict params: SBB parameters, read from params.json if not given
+        @param str results_path: output directory, with one subdirectory of buffer logs per camera
+        @param int workers: number of worker processes, one per camera by default
+                            Every camera needs its own process, or cameras started late have their buffers pushed
+                            out of time order
+        @param int max_pending: buffers held for a camera waiting on the others before its oldest is pushed anyway
+        """
+        self.cameras = cameras
+        self.params = with_defaults(params) if params is not None else load_params()
+        self.results_path = results_path
+        self.workers = workers if workers is not None else len(cameras)
+        if self.workers < len(cameras):
+            raise ValueError("Got " + str(self.workers) + " workers for " + str(len(cameras)) +
+                             " cameras, each camera needs its own worker process")
+        self.max_pending = max_pending
+        self.metrics = Metrics()
+
+        self.buffer_index = 0
+
+        reset_results_dir(self.results_path)
+
+        # Buffer logs go to JSON files or a segment store, on a background thread unless async_writer is off
+        self.writer = make_writer(self.params, self.results_path)
+        self.priorityq = PriorityQ(self.params["max_memory_mb"], self.params["inflation_factor"],
+                                   self.params["fifo"], metrics=self.metrics, writer=self.writer,
+                                   policy=get_eviction_policy(self.params, get_rate_model(self.params["rate_model"])))
+
+    def run(self):
+        with multiprocessing.Manager() as manager:
+            queue = manager.Queue()
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = {camera: pool.submit(run_camera, camera, paths, self.params,
+                                               os.path.join(self.results_path, camera), queue)
+                           for camera, paths in self.cameras.items()}
+                self.arbitrate(queue, futures)
+                for future in futures.values():
+                    future.result()
+        if self.writer is not None:
+            self.writer.close(self.metrics)
+
+    def arbitrate(self, queue, futures):
+        # Pushes buffers from all cameras in order of their last frame
+        # A buffer is only pushed once every running camera has one pending, so the order doesn't depend on scheduling,
+        # unless a camera has more than max_pending buffers waiting on a slower one
+        order = {camera: i for i, camera in enumerate(self.cameras)}
+        pending = {camera: deque() for camera in self.cameras}
+        running = set(self.cameras)
+
+        while True:
+            while (all(pending[camera] for camera in running) and any(pending.values())) or \
+                  any(len(buffers) > self.max_pending for buffers in pending.values()):
+                camera = min((camera for camera in pending if pending[camera]),
+                             key=lambda camera: (pending[camera][0].index[-1], order[camera]))
+                if running and not all(pending[camera] for camera in running):
+                    self.metrics.incr("buffers_forced")
+                self.pushBuffer(camera, pending[camera].popleft())
+            if not running:
+                break
+
+            try:
+                camera, kind, payload = queue.get(timeout=ARBITER_POLL_INTERVAL)
+            except queue_module.Empty:
+                # A camera process killed outright fails its future without sending FAILED
+                for camera in running:
+                    if futures[camera].done() and futures[camera].exception() is not None:
+                        raise RuntimeError("Camera " + camera + " failed") from futures[camera].exception()
+                continue
+            if kind == BUFFER:
+                pending[camera].append(payload)
+            elif kind == DONE:
+                running.discard(camera)
+                self.metrics.merge(payload)
+                logger.info("Camera %s finished", camera)
+            else:
+                raise RuntimeError("Camera " + camera + " failed:\n" + payload)
+
+    def pushBuffer(self, camera, buffer):
+        # Numbers buffers globally so inflation favors recent buffers across cameras
+        buffer.setBufferIndex(self.buffer_index)
+        self.buffer_index += 1
+        self.priorityq.fakePush(buffer, os.path.join(self.results_path, camera))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Smart Black Box over several cameras with a shared storage budget")
+    parser.add_argument("cameras", help='JSON file mapping camera names to {"frames", "vad", "oad", "tracking"} paths')
+    parser.add_argument("--params", default="params.json")
+    parser.add_argument("--output", default=RESULTS_PATH, help="directory for per-camera buffer logs")
+    parser.add_argument("--workers", type=int, help="worker processes, one per camera by default and never fewer")
+    parser.add_argument("--max-pending", type=int, default=16,
+                        help="buffers held for a camera waiting on slower ones before they're pushed out of order")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--metrics", help="write run metrics here, as Prometheus text for .prom/.txt and JSON otherwise")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(message)s")
+    multi_sbb = MultiSBB(json.load(open(args.cameras)), params=load_params(args.params),
+                         results_path=args.output, workers=args.workers, max_pending=args.max_pending)
+    multi_sbb.run()
+    if args.metrics:
+        multi_sbb.metrics.export(args.metrics)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
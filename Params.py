@@ -0,0 +1,17 @@
+import os
+import json
+
+# The params.json shipped beside this file is the base every params file is read over, so a params file
+# written before an option existed leaves it out and runs with the shipped value
+DEFAULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "params.json")
+
+with open(DEFAULTS_PATH) as defaults_in:
+    DEFAULT_PARAMS = json.load(defaults_in)
+
+def with_defaults(params):
+    # Copy of params with DEFAULT_PARAMS filled in for the options it doesn't set
+    return dict(DEFAULT_PARAMS, **params)
+
+def load_params(path="params.json"):
+    with open(path) as params_in:
+        return with_defaults(json.load(params_in))
@@ -1,53 +1,209 @@
-import os
-from heapq import *
+import logging
+import numpy as np
+from IndexedHeap import IndexedHeap
+from Metrics import Metrics
+from LBO import optimize_batch, optimize_budget, lbo_budget, DEFAULT_RATE_MODEL
+from buffer import drop_logs, write_log
+
+logger = logging.getLogger(__name__)
+
+class BufferRecord:
+    # What the queue keeps of a dumped buffer, instead of the buffer and its per-frame columns
+    # Only a degrading policy needs the columns LBO ran on, and only for fake compressed buffers
+    __slots__ = ("buffer_index", "buffer_value", "buffer_cost", "total_value", "log_addr", "frames_addr",
+                 "level", "lbo_value", "data_size", "frame", "references")
+
+    def __init__(self, buffer, keep_columns=False):
+        self.buffer_index = buffer.buffer_index
+        self.buffer_value = buffer.buffer_value
+        self.buffer_cost = buffer.buffer_cost
+        self.total_value = buffer.totalValue()
+        self.log_addr = buffer.log_addr
+        self.frames_addr = buffer.frames_addr
+        # Number of times the buffer has been recompressed since it was pushed
+        self.level = 0
+        self.lbo_value = None
+        self.data_size = None
+        self.frame = None
+        self.references = None
+        if keep_columns and buffer.lbo_value is not None and buffer.frames_addr is None:
+            self.lbo_value = buffer.lbo_value
+            self.data_size = buffer.data_size.copy()
+            self.frame = buffer.index.copy()
+            self.references = buffer.references
+
+class DegradePolicy:
+    # Eviction policy recompressing resident buffers before dropping them
+    # Step k reruns LBO with zeta scaled by factor**k, so lower-value frames are compressed harder each step,
+    # and a buffer is only dropped once it has been through every step
+    # Buffers given a byte budget by LBO are instead recompressed to factor times their current size each step
+
+    def __init__(self, eta, zeta, factor=0.5, steps=3, model=DEFAULT_RATE_MODEL, budgeted=False):
+        self.eta = eta
+        self.zeta = zeta
+        self.factor = factor
+        self.steps = steps
+        self.model = model
+        self.budgeted = budgeted
+
+    def degrade(self, record):
+        # Returns the next step's (decision, cost, value) for record, or None if it can't be degraded further
+        if record.lbo_value is None or record.level >= self.steps:
+            return None
+        if self.budgeted:
+            decision = optimize_budget(record.data_size, record.lbo_value, record.buffer_cost * self.factor, self.model)
+            # A budget even all-zero decisions exceed can't be met by recompressing, so the buffer is evicted instead
+            if decision is None:
+                return None
+        else:
+            zeta = self.zeta * self.factor ** (record.level + 1)
+            decision = optimize_batch(record.data_size, record.lbo_value, self.eta, zeta, self.model)
+        return decision, record.data_size * self.model.phi(decision), record.lbo_value * decision
+
+# Policies selectable by params["eviction_policy"]
+EVICTION_POLICIES = ("evict", "degrade")
+
+def get_eviction_policy(params, model=DEFAULT_RATE_MODEL):
+    # Plain eviction is no policy at all
+    if params["eviction_policy"] == "evict":
+        return None
+    if params["eviction_policy"] == "degrade":
+        return DegradePolicy(params["eta"], params["zeta"], params["degrade_factor"], params["degrade_steps"], model,
+                             lbo_budget(params) is not None)
+    raise ValueError("Unknown eviction policy " + str(params["eviction_policy"]))
 
 class PriorityQ:
     # Class for prioritized data recording
+    # Buffers are kept in an indexed heap keyed by buffer index, with priority buffer_value,
+    # or the buffer index itself in FIFO mode so the oldest buffer is evicted first
+    # With a DegradePolicy, buffers are ordered by how often they've been recompressed first
 
-    def __init__(self, max_memory_mb, inflation_factor, fifo=False):
-        self.data = []
+    def __init__(self, max_memory_mb, inflation_factor, fifo=False, metrics=None, writer=None, policy=None):
+        self.heap = IndexedHeap()
+        self.records = {}
         self.max_memory = max_memory_mb * 1024 * 1024
         self.inflation_factor = inflation_factor
         self.fifo = fifo
         self.cost = 0
         self.value = 0
-    
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Optional BufferWriter taking log writes and deletions off the calling thread
+        self.writer = writer
+        self.policy = policy
+
+    def __getstate__(self):
+        # The writer runs a thread, so it's left out of checkpoints and reattached on resume
+        state = self.__dict__.copy()
+        state["writer"] = None
+        return state
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, buffer_index):
+        return buffer_index in self.records
+
+    def _priority(self, record):
+        priority = record.buffer_index if self.fifo else record.buffer_value
+        return priority if self.policy is None else (record.level, priority)
+
     def fakePush(self, buffer, path):
-        # Pushes a buffer into the heapq
+        # Pushes a buffer into the queue
         buffer.setBufferValue(self.inflation_factor)
 
-        if self.fifo:
-            buffer.fakeDump(path, self.fifo)
-            self.data.append(buffer)
-        else:
+        if not self.fifo:
             # Discard if there's no space and value is less than min and buffer is not first
-            if len(self.data) == 0 and buffer.totalCost() > self.max_memory:
+            # A degrading policy makes space by recompressing instead, so only an oversized first buffer is discarded
+            if len(self.heap) == 0 and buffer.totalCost() > self.max_memory:
+                buffer.dropFrames(self.writer)
+                self.metrics.incr("buffers_rejected")
                 return
-            elif len(self.data) != 0 and buffer.buffer_value < self.data[0].buffer_value and \
+            elif self.policy is None and len(self.heap) != 0 and buffer.buffer_value < self.heap.peek()[1] and \
                self.cost + buffer.totalCost() > self.max_memory:
+                buffer.dropFrames(self.writer)
+                self.metrics.incr("buffers_rejected")
                 return
-            buffer.fakeDump(path, self.fifo)
-            heappush(self.data, buffer)
-        
-        self.cost += buffer.buffer_cost
-        self.value += buffer.totalValue()
-
-        print("Buffer " + str(buffer.buffer_index) + " with total value " +
-              str(buffer.totalValue()) + " and cost " + str(buffer.buffer_cost) +
-              " pushed!")
-
-        # Pop buffers if needed
-        while self.cost >= self.max_memory:
-            if self.fifo:
-                removed_buffer = self.data.pop(0)
-                removed_buffer.fakeDrop()
-                self.cost -= removed_buffer.buffer_cost
-                self.value -= removed_buffer.buffer_value
+
+        with self.metrics.timer("dump"):
+            buffer.fakeDump(path, self.fifo, self.writer)
+        record = BufferRecord(buffer, keep_columns=self.policy is not None)
+        self.records[record.buffer_index] = record
+        self.heap.push(record.buffer_index, self._priority(record))
+        self.cost += record.buffer_cost
+        self.value += record.total_value
+        self.metrics.incr("buffers_pushed")
+
+        logger.info("Buffer %d with total value %s and cost %s pushed!",
+                    record.buffer_index, record.total_value, record.buffer_cost)
+
+        self.evict()
+
+    def _take(self, buffer_index):
+        # Removes a record from the totals, resetting them once empty so rounding can't accumulate
+        record = self.records.pop(buffer_index)
+        if self.records:
+            self.cost -= record.buffer_cost
+            self.value -= record.total_value
+        else:
+            self.cost = 0
+            self.value = 0
+        return record
+
+    def _degrade(self, record, degraded):
+        # Rewrites record's log with its next recompression step and queues it again
+        decision, cost, value = degraded
+        buffer_cost = float(np.sum(cost))
+        total_value = float(np.sum(value))
+        self.cost += buffer_cost - record.buffer_cost
+        self.value += total_value - record.total_value
+        record.level += 1
+        record.buffer_cost = buffer_cost
+        record.total_value = total_value
+        record.buffer_value = (self.inflation_factor ** record.buffer_index) * float(np.max(value))
+        self.heap.push(record.buffer_index, self._priority(record))
+
+        log = {"value":value.tolist(), "cost":cost.tolist(), "frame":record.frame.tolist(),
+               "decision":decision.tolist()}
+        if record.references is not None:
+            log["references"] = record.references
+        write_log(record.log_addr, log, self.writer)
+        self.metrics.incr("buffers_degraded", level=record.level)
+        logger.info("Buffer %d degraded to level %d with total value %s and cost %s",
+                    record.buffer_index, record.level, total_value, buffer_cost)
+
+    def evict(self):
+        # Pops lowest priority buffers until under budget, recompressing them first if the policy can
+        # and dropping them together at the end
+        evicted = []
+        while self.cost >= self.max_memory and len(self.heap) > 0:
+            buffer_index, _ = self.heap.pop()
+            degraded = self.policy.degrade(self.records[buffer_index]) if self.policy is not None else None
+            if degraded is not None:
+                self._degrade(self.records[buffer_index], degraded)
             else:
-                removed_buffer = heappop(self.data)
-                removed_buffer.fakeDrop()
-                self.cost -= removed_buffer.buffer_cost
-                self.value -= removed_buffer.buffer_value
-            print("Buffer " + str(removed_buffer.buffer_index) + " with total value " +
-              str(removed_buffer.totalValue()) + " and cost " + str(removed_buffer.buffer_cost) +
-              " popped!")
+                evicted.append(self._take(buffer_index))
+
+        for record in evicted:
+            drop_logs(record.log_addr, record.frames_addr, self.writer)
+            self.metrics.incr("buffers_evicted")
+            logger.info("Buffer %d with total value %s and cost %s popped!",
+                        record.buffer_index, record.total_value, record.buffer_cost)
+
+        self.metrics.setGauge("bytes_kept", self.cost)
+        self.metrics.setGauge("buffers_kept", len(self.records))
+        return evicted
+
+    def remove(self, buffer_index):
+        # Drops a queued buffer regardless of its priority
+        self.heap.remove(buffer_index)
+        record = self._take(buffer_index)
+        drop_logs(record.log_addr, record.frames_addr, self.writer)
+        self.metrics.setGauge("bytes_kept", self.cost)
+        self.metrics.setGauge("buffers_kept", len(self.records))
+        return record
+
+    def reprioritize(self, buffer_index, buffer_value):
+        # Changes a queued buffer's value, and so its place in eviction order outside FIFO mode
+        record = self.records[buffer_index]
+        record.buffer_value = buffer_value
+        self.heap.update(buffer_index, self._priority(record))
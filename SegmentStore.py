@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import shutil
+import struct
+import numpy as np
+
+# Append-only binary store for buffer logs
+# A store is a directory of numbered segment files. Each segment starts with SEGMENT_MAGIC and holds records:
+#   header    RECORD_HEADER: magic, kind, name length, frame count, frames_dir length
+#   name      utf-8 key of the buffer, its log path relative to the store root without "_log.json"
+#   frames    utf-8 path of really compressed frames, empty if none
+#   columns   value, cost and decision as float32 then frame as int32, each frame count long
+# Records are padded to 8 bytes. A tombstone is a record with kind TOMBSTONE and no columns.
+# Reading only walks record headers, and the latest record for a name wins
+
+SEGMENT_MAGIC = b"SBBSEG01"
+RECORD_MAGIC = b"SBBR"
+RECORD_HEADER = struct.Struct("<4sBxHII")
+RECORD = 0
+TOMBSTONE = 1
+COLUMNS = (("value", np.float32), ("cost", np.float32), ("decision", np.float32), ("frame", np.int32))
+LOG_SUFFIX = "_log.json"
+
+def _pad(length):
+    return -length % 8
+
+def _segmentName(number):
+    return "segment{:06d}.sbbseg".format(number)
+
+def _segmentNumbers(store_path):
+    numbers = []
+    for name in os.listdir(store_path):
+        if name.startswith("segment") and name.endswith(".sbbseg"):
+            numbers.append(int(name[len("segment"):-len(".sbbseg")]))
+    return sorted(numbers)
+
+def _scanSegment(segment_path):
+    # Yields (kind, name, frames_dir, columns offset, frame count, record end) for each complete record
+    size = os.path.getsize(segment_path)
+    with open(segment_path, 'rb') as segment_in:
+        if segment_in.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            raise ValueError(segment_path + " is not a segment file")
+        offset = len(SEGMENT_MAGIC)
+        while offset + RECORD_HEADER.size <= size:
+            segment_in.seek(offset)
+            magic, kind, name_len, num_frames, frames_len = RECORD_HEADER.unpack(segment_in.read(RECORD_HEADER.size))
+            if magic != RECORD_MAGIC:
+                break
+            strings = segment_in.read(name_len + frames_len)
+            columns_offset = offset + RECORD_HEADER.size + name_len + frames_len
+            columns_offset += _pad(columns_offset)
+            end = columns_offset + (len(COLUMNS) * 4 * num_frames if kind == RECORD else 0)
+            end += _pad(end)
+            # A torn record at the end of a segment is from an interrupted write
+            if end > size:
+                break
+            yield (kind, strings[:name_len].decode(), strings[name_len:].decode() or None,
+                   columns_offset, num_frames, end)
+            offset = end
+
+def _encodeRecord(kind, name, log=None):
+    name_bytes = name.encode()
+    frames_bytes = (log.get("frames_dir") or "").encode() if log is not None else b""
+    num_frames = len(log["frame"]) if log is not None else 0
+    head = RECORD_HEADER.pack(RECORD_MAGIC, kind, len(name_bytes), num_frames, len(frames_bytes))
+    head += name_bytes + frames_bytes
+    parts = [head, bytes(_pad(len(head)))]
+    if kind == RECORD:
+        columns = b"".join(np.asarray(log[column], dtype=dtype).tobytes() for column, dtype in COLUMNS)
+        parts += [columns, bytes(_pad(len(columns)))]
+    return b"".join(parts)
+
+class SegmentStore:
+    # Class for appending buffer logs and tombstones to segment files
+    # Takes the same submit/drop calls as BufferWriter when used directly, and write/remove as its backend
+
+    def __init__(self, root_path, segment_max_mb=64, compact_ratio=0.5):
+        """
+        @param str root_path: results directory, buffer log paths are keyed relative to it
+        @param float segment_max_mb: size at which the active segment is closed and a new one started
+        @param float compact_ratio: fraction of dead bytes at which closing a segment compacts the store
+        """
+        self.root_path = root_path
+        self.store_path = os.path.join(root_path, "segments")
+        self.segment_max = segment_max_mb * 1024 * 1024
+        self.compact_ratio = compact_ratio
+        os.makedirs(self.store_path, exist_ok=True)
+
+        # Live record sizes by name, for deciding when to compact
+        self.live = {}
+        self.total_bytes = 0
+        numbers = _segmentNumbers(self.store_path)
+        for number in list(numbers):
+            segment_path = os.path.join(self.store_path, _segmentName(number))
+            # A segment torn before its magic was written holds no records
+            if os.path.getsize(segment_path) < len(SEGMENT_MAGIC):
+                os.remove(segment_path)
+                numbers.remove(number)
+                continue
+            start = len(SEGMENT_MAGIC)
+            for kind, name, frames_dir, columns_offset, num_frames, end in _scanSegment(segment_path):
+                self.live.pop(name, None)
+                if kind == RECORD:
+                    self.live[name] = end - start
+                self.total_bytes += end - start
+                start = end
+            # A record torn by a crash is cut off, so it neither lingers in the store nor hides from compaction
+            if os.path.getsize(segment_path) > start:
+                with open(segment_path, 'r+b') as segment_out:
+                    segment_out.truncate(start)
+        self.number = numbers[-1] + 1 if numbers else 0
+        self.segment = None
+        self._open()
+
+    def _open(self):
+        self.segment_path = os.path.join(self.store_path, _segmentName(self.number))
+        self.segment = open(self.segment_path, 'ab')
+        self.segment.write(SEGMENT_MAGIC)
+        self.segment.flush()
+
+    def key(self, log_addr):
+        # Store key of a buffer log path
+        name = os.path.relpath(log_addr, self.root_path)
+        return name[:-len(LOG_SUFFIX)] if name.endswith(LOG_SUFFIX) else name
+
+    def _append(self, record, name, live, sync=False):
+        self.segment.write(record)
+        self.segment.flush()
+        if sync:
+            os.fsync(self.segment.fileno())
+        self.live.pop(name, None)
+        if live:
+            self.live[name] = len(record)
+        self.total_bytes += len(record)
+        if self.segment.tell() >= self.segment_max:
+            self._roll()
+
+    def write(self, log_addr, log, sync=False):
+        # Appends a buffer's record and returns the file to sync for it
+        name = self.key(log_addr)
+        segment_path = self.segment_path
+        self._append(_encodeRecord(RECORD, name, log), name, True, sync)
+        return segment_path
+
+    def remove(self, log_addr, sync=False):
+        # Appends a tombstone for a buffer's record and returns the file to sync for it
+        name = self.key(log_addr)
+        segment_path = self.segment_path
+        if name in self.live:
+            self._append(_encodeRecord(TOMBSTONE, name), name, False, sync)
+        return segment_path
+
+    def flush(self):
+        # Records are already written through on append, this makes them durable
+        os.fsync(self.segment.fileno())
+
+    def submit(self, log_addr, log):
+        self.write(log_addr, log)
+
+    def drop(self, log_addr, frames_addr=None):
+        self.remove(log_addr)
+        if frames_addr is not None:
+            shutil.rmtree(frames_addr, ignore_errors=True)
+
+    def _roll(self):
+        # Starts a new segment, compacting first if enough of the store is dead
+        self.segment.close()
+        self.number += 1
+        live_bytes = sum(self.live.values())
+        if self.total_bytes > 0 and 1 - live_bytes / self.total_bytes >= self.compact_ratio:
+            self.compact()
+        else:
+            self._open()
+
+    def compact(self):
+        # Rewrites every live record into a new segment and deletes the old ones
+        # Tombstones are no longer needed since nothing older survives
+        if self.segment is not None and not self.segment.closed:
+            self.segment.close()
+            self.number += 1
+        old_numbers = [number for number in _segmentNumbers(self.store_path) if number < self.number]
+        reader = SegmentReader(self.root_path)
+
+        self._open()
+        self.live = {}
+        self.total_bytes = 0
+        for name in reader.names():
+            record = _encodeRecord(RECORD, name, reader.read(name))
+            self.segment.write(record)
+            self.live[name] = len(record)
+            self.total_bytes += len(record)
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        reader.close()
+
+        for number in old_numbers:
+            os.remove(os.path.join(self.store_path, _segmentName(number)))
+
+    def close(self, metrics=None):
+        if not self.segment.closed:
+            self.segment.close()
+        if metrics is not None:
+            metrics.setGauge("segment_live_bytes", sum(self.live.values()))
+            metrics.setGauge("segment_total_bytes", self.total_bytes)
+
+class SegmentReader:
+    # Class for reading buffer logs out of a segment store without parsing them
+    # Columns are zero-copy views of memory-mapped segments
+
+    def __init__(self, root_path):
+        self.store_path = os.path.join(root_path, "segments")
+        self.maps = {}
+        self.index = {}
+        for number in _segmentNumbers(self.store_path):
+            segment_path = os.path.join(self.store_path, _segmentName(number))
+            for kind, name, frames_dir, columns_offset, num_frames, end in _scanSegment(segment_path):
+                if kind == RECORD:
+                    self.index[name] = (segment_path, frames_dir, columns_offset, num_frames)
+                else:
+                    self.index.pop(name, None)
+
+    def names(self):
+        return sorted(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _map(self, segment_path):
+        if segment_path not in self.maps:
+            self.maps[segment_path] = np.memmap(segment_path, dtype=np.uint8, mode="r").view(np.ndarray)
+        return self.maps[segment_path]
+
+    def read(self, name):
+        # Returns a buffer's value, cost, decision and frame arrays, plus frames_dir if it has one
+        segment_path, frames_dir, offset, num_frames = self.index[name]
+        mapped = self._map(segment_path)
+        log = {}
+        for column, dtype in COLUMNS:
+            log[column] = mapped[offset:offset + 4 * num_frames].view(dtype)
+            offset += 4 * num_frames
+        if frames_dir is not None:
+            log["frames_dir"] = frames_dir
+        return log
+
+    def buffer(self, buffer_index, fifo=False, camera=None):
+        # Reads a buffer by index, the way PriorityQ names its log
+        name = ("fifo_" if fifo else "priority_") + "buffer" + str(buffer_index)
+        return self.read(os.path.join(camera, name) if camera is not None else name)
+
+    def exportJSON(self, out_path):
+        # Writes every live buffer as the *_log.json files of the JSON backend
+        for name in self.names():
+            log = self.read(name)
+            log_addr = os.path.join(out_path, name + LOG_SUFFIX)
+            os.makedirs(os.path.dirname(log_addr), exist_ok=True)
+            json_log = {"value": log["value"].tolist(), "cost": log["cost"].tolist(),
+                        "frame": log["frame"].tolist(), "decision": log["decision"].tolist()}
+            if "frames_dir" in log:
+                json_log["frames_dir"] = log["frames_dir"]
+            with open(log_addr, 'w') as log_out:
+                json.dump(json_log, log_out)
+
+    def close(self):
+        self.maps = {}
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Error! Usage is: python3 SegmentStore.py <results_path> <json_output_path>")
+        exit()
+    SegmentReader(sys.argv[1]).exportJSON(sys.argv[2])
@@ -0,0 +1,161 @@
+import os
+import sys
+import numpy as np
+from TrackingOutput import CSRTracking, load_tracking, to_csr
+from FrameManifest import save_cache
+
+INDEX_SUFFIX = ".sbb_tracks.npz"
+
+ALL_BITS = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+def popcount(words):
+    # Number of set bits in each uint64 word
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).astype(np.int64)
+    return _BYTE_COUNTS[words.view(np.uint8).reshape(words.shape + (8,))].sum(axis=-1, dtype=np.int64)
+
+_BYTE_COUNTS = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)
+
+class TrackIndex:
+    # Class for the frames every track appears in, precomputed from the whole tracking output
+    # Track IDs are remapped to dense ints, and each track's frames from its first to its last are a packed bitset,
+    # so whether a track appears anywhere in a range of frames is a popcount over a few words
+    # Cached beside the tracking output, keyed by its mtime and size
+
+    ARRAYS = ("track_ids", "first", "last", "word_start", "words", "word_counts",
+              "frame_indptr", "frame_tracks", "frame_lengths")
+
+    def __init__(self, arrays, tracking_path=None, stat=(0, 0)):
+        for name in TrackIndex.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.tracking_path = tracking_path
+        self.stat = stat
+
+    def __len__(self):
+        return len(self.frame_lengths)
+
+    @staticmethod
+    def cachePath(tracking_path):
+        return tracking_path + INDEX_SUFFIX
+
+    @staticmethod
+    def statKey(tracking_path):
+        stat = os.stat(tracking_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    @classmethod
+    def build(cls, indptr, track_ids, tracking_path=None, stat=(0, 0)):
+        # Builds the index from CSR tracking output
+        indptr = np.asarray(indptr, dtype=np.int64)
+        num_frames = len(indptr) - 1
+        frame_lengths = np.diff(indptr)
+        original_ids, dense = np.unique(np.asarray(track_ids), return_inverse=True)
+        num_tracks = len(original_ids)
+
+        # Each (frame, track) pair once, ordered by frame then track
+        frames = np.repeat(np.arange(num_frames, dtype=np.int64), frame_lengths)
+        pairs = np.unique(frames * max(num_tracks, 1) + dense.reshape(-1))
+        pair_frames = pairs // max(num_tracks, 1)
+        pair_tracks = pairs % max(num_tracks, 1)
+        frame_indptr = np.searchsorted(pair_frames, np.arange(num_frames + 1))
+
+        # The same pairs ordered by track then frame give each track's first and last frame
+        order = np.argsort(pair_tracks, kind="stable")
+        track_frames = pair_frames[order]
+        sorted_tracks = pair_tracks[order]
+        track_starts = np.searchsorted(sorted_tracks, np.arange(num_tracks + 1))
+        first = track_frames[track_starts[:-1]]
+        last = track_frames[track_starts[1:] - 1]
+
+        # One bit per frame from first to last, in whole words per track
+        word_start = np.zeros(num_tracks + 1, dtype=np.int64)
+        np.cumsum((last - first) // 64 + 1, out=word_start[1:])
+        words = np.zeros(word_start[-1], dtype=np.uint64)
+        bits = track_frames - first[sorted_tracks]
+        np.bitwise_or.at(words, word_start[sorted_tracks] + bits // 64,
+                         np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64)))
+        # word_counts[w] is the number of bits set in words before w
+        word_counts = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum(popcount(words), out=word_counts[1:])
+
+        return cls({"track_ids": original_ids, "first": first, "last": last, "word_start": word_start,
+                    "words": words, "word_counts": word_counts, "frame_indptr": frame_indptr,
+                    "frame_tracks": pair_tracks, "frame_lengths": frame_lengths}, tracking_path, stat)
+
+    @classmethod
+    def fromTracking(cls, tracking_output, tracking_path=None, stat=(0, 0)):
+        # Builds the index from loaded tracking output in either format
+        if isinstance(tracking_output, CSRTracking):
+            return cls.build(tracking_output.indptr, tracking_output.track_ids, tracking_path, stat)
+        return cls.build(*to_csr(tracking_output), tracking_path, stat)
+
+    @classmethod
+    def load(cls, tracking_path, tracking_output=None, cache=True):
+        # Loads the cached index if the tracking output hasn't changed since it was built, else rebuilds it
+        stat = TrackIndex.statKey(tracking_path)
+        if cache:
+            try:
+                with np.load(cls.cachePath(tracking_path)) as cached:
+                    if tuple(int(v) for v in cached["stat"]) == stat:
+                        return cls({name: cached[name] for name in TrackIndex.ARRAYS}, tracking_path, stat)
+            except (OSError, KeyError, ValueError):
+                pass
+
+        if tracking_output is None:
+            tracking_output = load_tracking(tracking_path)
+        index = cls.fromTracking(tracking_output, tracking_path, stat)
+        if cache:
+            index.save()
+        return index
+
+    def save(self):
+        save_cache(TrackIndex.cachePath(self.tracking_path), stat=np.array(self.stat, dtype=np.int64),
+                   **{name: getattr(self, name) for name in TrackIndex.ARRAYS})
+
+    def present(self, tracks, start, end):
+        # Whether each dense track ID appears in any frame from start to end, inclusive
+        first = self.first[tracks]
+        lo = np.maximum(start, first)
+        hi = np.minimum(end, self.last[tracks])
+        overlaps = lo <= hi
+        lo_bit = np.where(overlaps, lo - first, 0)
+        hi_bit = np.where(overlaps, hi - first, 0)
+        lo_word = self.word_start[tracks] + lo_bit // 64
+        hi_word = self.word_start[tracks] + hi_bit // 64
+        lo_mask = np.left_shift(ALL_BITS, (lo_bit % 64).astype(np.uint64))
+        hi_mask = np.right_shift(ALL_BITS, (63 - hi_bit % 64).astype(np.uint64))
+
+        words = self.words
+        same_word = lo_word == hi_word
+        counts = np.where(same_word, popcount(words[lo_word] & lo_mask & hi_mask),
+                          popcount(words[lo_word] & lo_mask) + popcount(words[hi_word] & hi_mask) +
+                          self.word_counts[hi_word] - self.word_counts[np.minimum(lo_word + 1, hi_word)])
+        return overlaps & (counts > 0)
+
+    def similarities(self, frames, start, ends):
+        # Fraction of each frame's track IDs that appear in frames start to ends, inclusive,
+        # the same as Buffer.calcSimilarity for a buffer holding exactly those frames
+        frames = np.asarray(frames, dtype=np.int64)
+        ends = np.broadcast_to(ends, frames.shape)
+        entry_start = self.frame_indptr[frames]
+        entry_counts = self.frame_indptr[frames + 1] - entry_start
+        owner = np.repeat(np.arange(len(frames)), entry_counts)
+        entries = np.arange(len(owner)) + np.repeat(entry_start - (np.cumsum(entry_counts) - entry_counts),
+                                                    entry_counts)
+        present = self.present(self.frame_tracks[entries], start, ends[owner])
+        intersecting = np.bincount(owner, weights=present, minlength=len(frames))
+
+        lengths = self.frame_lengths[frames]
+        sims = np.zeros(len(frames))
+        np.divide(intersecting, lengths, out=sims, where=lengths > 0)
+        return sims
+
+    def similarity(self, frame, start, end):
+        return float(self.similarities([frame], start, end)[0])
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Error! Usage is: python3 TrackIndex.py <obj_tracking_output>")
+        exit()
+    index = TrackIndex.load(sys.argv[1])
+    print("Indexed %d frames, %d tracks in %d words" % (len(index), len(index.track_ids), len(index.words)))
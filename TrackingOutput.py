@@ -0,0 +1,85 @@
+import sys
+import struct
+import zipfile
+import numpy as np
+
+# Object tracking output comes either as a pickled list of per-frame track ID lists (.npy/.pkl)
+# or in CSR form: an uncompressed .npz with "indptr" (N+1,) and "track_ids" arrays,
+# where frame i's IDs are track_ids[indptr[i]:indptr[i+1]]
+
+class CSRTracking:
+    # Class for CSR-encoded tracking output, indexable like the list of lists
+
+    def __init__(self, indptr, track_ids):
+        self.indptr = indptr
+        self.track_ids = track_ids
+
+    def __getitem__(self, i):
+        # Zero-copy view of the track IDs in frame i
+        return self.track_ids[self.indptr[i]:self.indptr[i+1]]
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+def to_csr(tracking_output):
+    # Encodes a list of per-frame track ID lists as (indptr, track_ids)
+    lengths = np.fromiter((len(track_ids) for track_ids in tracking_output), dtype=np.int64,
+                          count=len(tracking_output))
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    track_ids = np.fromiter((track_id for frame_ids in tracking_output for track_id in frame_ids),
+                            dtype=np.int64, count=indptr[-1])
+    return indptr, track_ids
+
+def convert_tracking(tracking_path, csr_path):
+    # Converts pickled tracking output to a CSR .npz
+    indptr, track_ids = to_csr(np.load(tracking_path, allow_pickle=True))
+    with open(csr_path, 'wb') as csr_out:
+        np.savez(csr_out, indptr=indptr, track_ids=track_ids)
+
+def is_csr(tracking_path):
+    # CSR files are zip archives, pickled output is a plain .npy or pickle
+    return zipfile.is_zipfile(tracking_path)
+
+def load_tracking(tracking_path, mmap=True):
+    # Loads tracking output in either format, memory-mapping CSR arrays when possible
+    if not is_csr(tracking_path):
+        return np.load(tracking_path, allow_pickle=True)
+    if mmap:
+        return CSRTracking(mmap_npz_member(tracking_path, "indptr"), mmap_npz_member(tracking_path, "track_ids"))
+    with np.load(tracking_path) as csr:
+        return CSRTracking(csr["indptr"], csr["track_ids"])
+
+def mmap_npz_member(npz_path, name):
+    # Memory-maps an array stored uncompressed in an .npz, falling back to reading it
+    with zipfile.ZipFile(npz_path) as archive:
+        info = archive.getinfo(name + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(npz_path) as npz:
+            return npz[name]
+
+    with open(npz_path, 'rb') as npz_in:
+        # Skip the zip local file header to reach the .npy data
+        npz_in.seek(info.header_offset)
+        local_header = npz_in.read(30)
+        name_len, extra_len = struct.unpack("<HH", local_header[26:30])
+        npz_in.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(npz_in)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npz_in)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npz_in)
+        offset = npz_in.tell()
+
+    if 0 in shape:
+        return np.empty(shape, dtype=dtype)
+    mapped = np.memmap(npz_path, dtype=dtype, mode="r", offset=offset, shape=shape,
+                       order="F" if fortran_order else "C")
+    # Plain ndarray view of the mapping, since slicing a memmap is much slower
+    return mapped.view(np.ndarray)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Error! Usage is: python3 TrackingOutput.py <obj_tracking_output> <csr_output.npz>")
+        exit()
+    convert_tracking(sys.argv[1], sys.argv[2])
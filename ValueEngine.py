@@ -0,0 +1,86 @@
+import json
+import numpy as np
+from IBCC import IBCC, ibcc_probs
+
+# Value functions keyed by params["value_type"]
+# Each takes (engine, vad_scores, oad_scores) for N frames and returns an (N,) array of values
+VALUE_FUNCTIONS = {}
+
+def register_value(name):
+    # Decorator adding a value function to the registry
+    def register(value_fn):
+        VALUE_FUNCTIONS[name] = value_fn
+        return value_fn
+    return register
+
+def normalize_vad(vad_scores, vad_range=None):
+    # Min-max normalizes VAD scores, using vad_range=(min, max) if given
+    vad_scores = np.array(vad_scores, dtype=np.result_type(vad_scores, float))
+    vad_min, vad_max = vad_range if vad_range is not None else (np.min(vad_scores), np.max(vad_scores))
+    vad_scores -= vad_min
+    vad_scores /= (vad_max - vad_min)
+    return vad_scores
+
+def scan_vad_range(vad_scores, block_size=65536):
+    # Finds the (min, max) of VAD scores block by block, so memory-mapped scores are never fully loaded
+    vad_min, vad_max = np.inf, -np.inf
+    for start in range(0, len(vad_scores), block_size):
+        block = np.asarray(vad_scores[start:start+block_size])
+        vad_min = min(vad_min, np.min(block))
+        vad_max = max(vad_max, np.max(block))
+    return vad_min, vad_max
+
+# Parameters that change frame values, so runs agreeing on them can share one value computation
+VALUE_PARAMS = ("value_type", "class_values", "hybrid_value_alpha", "hybrid_value_beta",
+                "confusion_prior_init", "class_prob_prior_init")
+
+def value_config(params):
+    # Hashable key of the value parameters in params
+    return json.dumps({name: params[name] for name in VALUE_PARAMS}, sort_keys=True)
+
+class ValueEngine:
+    # Class for computing frame values from VAD and OAD scores
+
+    def __init__(self, params):
+        self.params = params
+        self.value_type = params["value_type"]
+        # Unknown value types fall back to the raw VAD score
+        self.value_fn = VALUE_FUNCTIONS.get(self.value_type, VALUE_FUNCTIONS["vad"])
+        self.class_values = np.array(params["class_values"], dtype=float)
+        self.ibcc = None
+
+    def getIBCC(self):
+        # Builds the IBCC combiner on first use
+        if self.ibcc is None:
+            self.ibcc = IBCC(self.params["confusion_prior_init"], self.params["class_prob_prior_init"])
+        return self.ibcc
+
+    def compute(self, vad_scores, oad_scores):
+        # Computes values for a block of frames
+        return self.value_fn(self, np.asarray(vad_scores), np.asarray(oad_scores))
+
+    def computeFrame(self, oad_scores, vad_score):
+        # Computes the value of a single frame
+        return self.compute(np.array([vad_score]), np.array([oad_scores]))[0]
+
+    def oadValue(self, oad_scores):
+        # Weights OAD action class probabilities by their class values
+        return oad_scores[:,1:] @ self.class_values
+
+@register_value("ibcc")
+def ibcc_value(engine, vad_scores, oad_scores):
+    return engine.getIBCC().inferVB_batch(*ibcc_probs(vad_scores, oad_scores))[:,1]
+
+@register_value("oad")
+def oad_value(engine, vad_scores, oad_scores):
+    return engine.oadValue(oad_scores)
+
+@register_value("hybrid")
+def hybrid_value(engine, vad_scores, oad_scores):
+    value = engine.params["hybrid_value_alpha"] * engine.oadValue(oad_scores)
+    value += engine.params["hybrid_value_beta"] * vad_scores
+    return value
+
+@register_value("vad")
+def vad_value(engine, vad_scores, oad_scores):
+    return np.array(vad_scores, dtype=float)
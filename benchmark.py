@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+from types import SimpleNamespace
+import numpy as np
+from ValueEngine import ValueEngine
+from buffer import Buffer, gaussian
+from TrackingOutput import convert_tracking
+from PriorityQueue import PriorityQ, EVICTION_POLICIES
+from IBCC import IBCC, ibcc_probs
+from sbb import SingleSBB
+from synthetic import generate_recording, synthetic_tracks, to_object_array, write_images
+from Compression import ImageCompressor
+from Params import load_params
+
+# Benchmarks for SBB hot paths
+# Usage: python3 benchmark.py <benchmark> [options]
+# Results are printed as JSON rows
+
+def timeit(fn, repeat=1):
+    # Returns the best wall time of fn over repeat runs
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def peak_rss_kb():
+    # Peak resident set size of this process
+    # VmHWM is per address space, while ru_maxrss carries over the parent's peak through fork and exec
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def loop_values(params, vad_scores, oad_scores):
+    # Per-frame value loop SingleSBB used before ValueEngine
+    data_values = np.zeros(vad_scores.shape)
+    for i in range(len(vad_scores)):
+        if params["value_type"] == "oad":
+            data_values[i] = np.sum(np.multiply(np.array(params["class_values"]), oad_scores[i][1:]))
+        elif params["value_type"] == "hybrid":
+            value = params["hybrid_value_alpha"] * np.sum(np.multiply(np.array(params["class_values"]), oad_scores[i][1:]))
+            value += params["hybrid_value_beta"] * vad_scores[i]
+            data_values[i] = value
+        else:
+            data_values[i] = vad_scores[i]
+    return data_values
+
+def bench_values(args, params):
+    # Compares ValueEngine with the per-frame loop for the oad and hybrid value types
+    rng = np.random.default_rng(0)
+    rows = []
+    for size in args.sizes:
+        vad_scores = rng.random(size)
+        oad_scores = rng.random((size, len(params["class_values"]) + 1)).astype(np.float32)
+        for value_type in ("oad", "hybrid"):
+            run_params = dict(params, value_type=value_type)
+            engine = ValueEngine(run_params)
+            engine_time = timeit(lambda: engine.compute(vad_scores, oad_scores), args.repeat)
+            row = {"benchmark": "values", "value_type": value_type, "frames": size,
+                   "engine_s": engine_time, "engine_fps": size / engine_time}
+            if size <= args.loop_max:
+                loop_time = timeit(lambda: loop_values(run_params, vad_scores, oad_scores))
+                row.update({"loop_s": loop_time, "loop_fps": size / loop_time,
+                            "speedup": loop_time / engine_time})
+            rows.append(row)
+    return rows
+
+def loop_filter(values, sigma):
+    # Per-edge filterValue loop Buffer used before vectorization
+    N = len(values)
+    filtered_value = list(values)
+    for i in range(1, N):
+        if values[i] > values[i-1]:
+            mu = i
+            a = values[i] - values[i-1]
+            for j in range(max(mu - 3*sigma, 0), mu):
+                filtered_value[j] = max(filtered_value[j], gaussian(j,a,mu,sigma))
+        elif values[i] < values[i-1]:
+            mu = i
+            a = values[i-1] - values[i]
+            for j in range(mu, min(mu + 3*sigma, N)):
+                filtered_value[j] = max(filtered_value[j], gaussian(j,a,mu,sigma))
+    return filtered_value
+
+def make_buffer(values, cost=60000):
+    # Builds a buffer of frames with the given values, each of size cost bytes
+    buffer = Buffer(capacity=len(values))
+    for i, value in enumerate(values):
+        buffer.append(SimpleNamespace(data_ptr="", index=i, value=value, anomaly_score=0.0, cost=cost, objects=[]))
+    return buffer
+
+def bench_filter(args, params):
+    # Compares the vectorized Buffer.filterValue with the per-edge loop on noisy OAD-like values
+    rng = np.random.default_rng(0)
+    rows = []
+    for size in args.buffer_sizes:
+        values = rng.random(size)
+        for sigma in args.sigmas:
+            buffer = make_buffer(values)
+            def run():
+                buffer.value = values
+                buffer.filterValue(sigma)
+            vector_time = timeit(run, args.repeat)
+            loop_time = timeit(lambda: loop_filter(values.tolist(), sigma), args.repeat)
+            rows.append({"benchmark": "filter", "frames": size, "sigma": sigma,
+                         "vector_s": vector_time, "loop_s": loop_time, "speedup": loop_time / vector_time})
+    return rows
+
+# Run in a fresh interpreter so peak RSS only reflects loading one tracking file
+TRACKING_LOAD_SCRIPT = """
+import sys, json, time
+from benchmark import peak_rss_kb
+from TrackingOutput import load_tracking
+baseline_rss = peak_rss_kb()
+start = time.perf_counter()
+tracking_output = load_tracking(sys.argv[1])
+load_time = time.perf_counter() - start
+num_ids = sum(len(tracking_output[i]) for i in range(len(tracking_output)))
+access_time = time.perf_counter() - start - load_time
+print(json.dumps({"load_s": load_time, "access_s": access_time, "num_ids": num_ids,
+                  "rss_kb": peak_rss_kb() - baseline_rss}))
+"""
+
+def bench_tracking(args, params):
+    # Compares startup time and RSS of pickled and CSR tracking output
+    rng = np.random.default_rng(0)
+    repo_path = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_path:
+        for size in args.tracking_sizes:
+            pickle_path = os.path.join(tmp_path, "tracking.npy")
+            csr_path = os.path.join(tmp_path, "tracking.npz")
+            tracking_output = to_object_array(synthetic_tracks(size, rng))
+            np.save(pickle_path, tracking_output, allow_pickle=True)
+            convert_tracking(pickle_path, csr_path)
+            del tracking_output
+
+            for tracking_format, path in (("pickle", pickle_path), ("csr", csr_path)):
+                result = subprocess.run([sys.executable, "-c", TRACKING_LOAD_SCRIPT, path], cwd=repo_path,
+                                        capture_output=True, text=True, check=True)
+                row = {"benchmark": "tracking", "format": tracking_format, "frames": size,
+                       "file_bytes": os.path.getsize(path)}
+                row.update(json.loads(result.stdout))
+                rows.append(row)
+    return rows
+
+def bench_scale(paths, params, results_path, repeat=3):
+    # Times each pipeline stage on one synthetic recording
+    stages = {}
+    num_frames = len(np.load(paths["vad"], mmap_mode="r"))
+
+    start = time.perf_counter()
+    sbb = SingleSBB(paths["frames"], paths["vad"], paths["oad"], paths["tracking"],
+                    params=params, results_path=results_path)
+    stages["init"] = (time.perf_counter() - start, num_frames)
+
+    start = time.perf_counter()
+    sbb.run()
+    stages["run"] = (time.perf_counter() - start, num_frames)
+    stages["dmm_step"] = (sbb.metrics.timers["dmm_step"], num_frames)
+
+    values = sbb.data_values[:params["major_buffer_max"]]
+    buffer = make_buffer(values)
+    def filter_once():
+        buffer.value = values
+        buffer.filterValue(params["filter_sigma"])
+    stages["filter_value"] = (timeit(filter_once, repeat), len(values))
+
+    ibcc = IBCC(params["confusion_prior_init"], params["class_prob_prior_init"])
+    sample = min(num_frames, 1000)
+    vad_probs, oad_probs = ibcc_probs(sbb.vad_scores, sbb.oad_scores)
+    def infer_scalar():
+        for i in range(sample):
+            ibcc.inferVB({"VAD": vad_probs[i], "OAD": oad_probs[i]})
+    stages["ibcc_infer_vb"] = (timeit(infer_scalar), sample)
+    stages["ibcc_infer_vb_batch"] = (timeit(lambda: ibcc.inferVB_batch(vad_probs, oad_probs)), num_frames)
+    stages["ibcc_train_vb"] = (timeit(lambda: ibcc.trainVB(vad_probs, oad_probs)), num_frames)
+
+    # Push buffers into a queue that only holds a few of them, so pushes also evict
+    num_pushes = 200
+    buffer.decision = np.ones(buffer.size())
+    buffer.fakeCompress()
+    pushed = []
+    for i in range(num_pushes):
+        pushed.append(Buffer())
+        pushed[i].copy(buffer)
+        pushed[i].decision = buffer.decision
+        pushed[i].setBufferIndex(i)
+    priorityq = PriorityQ(5.5 * buffer.totalCost() / (1024 * 1024), params["inflation_factor"], params["fifo"])
+    def push_all():
+        for pushed_buffer in pushed:
+            priorityq.fakePush(pushed_buffer, results_path)
+    stages["fake_push"] = (timeit(push_all), num_pushes)
+
+    row = {"benchmark": "suite", "frames": num_frames, "peak_rss_kb": peak_rss_kb()}
+    for stage, (seconds, count) in stages.items():
+        row[stage + "_s"] = seconds
+        row[stage + "_per_s"] = count / seconds if seconds > 0 else None
+    return row
+
+# Each scale runs in a fresh interpreter so peak RSS is per scale
+SUITE_SCALE_SCRIPT = """
+import sys, json
+from benchmark import bench_scale
+print(json.dumps(bench_scale(json.loads(sys.argv[1]), json.loads(sys.argv[2]), sys.argv[3], int(sys.argv[4]))))
+"""
+
+def bench_suite(args, params):
+    # Runs the whole pipeline and its stages on synthetic recordings at several scales
+    repo_path = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    for size in args.scales:
+        with tempfile.TemporaryDirectory() as tmp_path:
+            paths = generate_recording(os.path.join(tmp_path, "recording"), size,
+                                       tracking_format=args.tracking_format)
+            result = subprocess.run([sys.executable, "-c", SUITE_SCALE_SCRIPT, json.dumps(paths), json.dumps(params),
+                                     os.path.join(tmp_path, "sbb_output"), str(args.repeat)],
+                                    cwd=repo_path, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError("Suite benchmark failed at scale " + str(size) + ":\n" + result.stderr)
+            row = json.loads(result.stdout)
+            row["tracking_format"] = args.tracking_format
+            rows.append(row)
+    return rows
+
+def bench_eviction(args, params):
+    # Compares value retained per stored byte between eviction policies under tight budgets
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_path:
+        paths = generate_recording(os.path.join(tmp_path, "recording"), args.scales[0],
+                                   tracking_format=args.tracking_format)
+        for budget in args.budgets:
+            for policy in EVICTION_POLICIES:
+                policy_params = dict(params, eviction_policy=policy, max_memory_mb=budget)
+                sbb = SingleSBB(paths["frames"], paths["vad"], paths["oad"], paths["tracking"],
+                                params=policy_params, results_path=os.path.join(tmp_path, "sbb_output"))
+                sbb.run()
+                counters = sbb.metrics.toDict()["counters"]
+                degraded = sum(counter["value"] for counter in counters if counter["name"] == "buffers_degraded")
+                priorityq = sbb.priorityq
+                rows.append({"benchmark": "eviction", "policy": policy, "frames": args.scales[0],
+                             "budget_mb": budget, "buffers_kept": len(priorityq), "bytes_kept": priorityq.cost,
+                             "value_kept": priorityq.value, "buffers_degraded": degraded,
+                             "value_per_mb": priorityq.value / (priorityq.cost / (1024 * 1024))
+                                             if priorityq.cost > 0 else None})
+    return rows
+
+def bench_compression(args, params):
+    # Measures real compression throughput against the number of workers
+    rng = np.random.default_rng(0)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_path:
+        frame_path = os.path.join(tmp_path, "frames")
+        write_images(frame_path, args.compression_frames, rng)
+        data_ptrs = sorted(os.path.join(frame_path, name) for name in os.listdir(frame_path))
+        input_bytes = sum(os.path.getsize(img_ptr) for img_ptr in data_ptrs)
+        decision = rng.random(len(data_ptrs))
+
+        for executor in ("thread", "process"):
+            for workers in args.workers:
+                compressor = ImageCompressor(workers, *params["compression_quality"], executor=executor)
+                out_path = os.path.join(tmp_path, "compressed")
+                seconds = timeit(lambda: compressor.compress(data_ptrs, decision, out_path), args.repeat)
+                compressor.close()
+                rows.append({"benchmark": "compression", "executor": executor, "workers": workers,
+                             "frames": len(data_ptrs), "seconds": seconds, "frames_per_s": len(data_ptrs) / seconds,
+                             "input_mb_per_s": input_bytes / seconds / (1024 * 1024)})
+    return rows
+
+def run_info():
+    # Identifies the code version and environment results were measured with
+    info = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0], "numpy": np.__version__}
+    try:
+        info["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info["commit"] = None
+    return info
+
+BENCHMARKS = {
+    "values": bench_values,
+    "filter": bench_filter,
+    "tracking": bench_tracking,
+    "suite": bench_suite,
+    "compression": bench_compression,
+    "eviction": bench_eviction,
+}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks for SBB hot paths")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--params", default="params.json")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000, 10000000])
+    parser.add_argument("--buffer-sizes", type=int, nargs="+", default=[150, 600, 2400])
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000],
+                        help="recording lengths for the suite benchmark")
+    parser.add_argument("--tracking-format", choices=["pickle", "csr"], default="csr")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="worker counts for the compression benchmark")
+    parser.add_argument("--compression-frames", type=int, default=200)
+    parser.add_argument("--budgets", type=float, nargs="+", default=[20, 50, 100],
+                        help="storage budgets in MB for the eviction benchmark")
+    parser.add_argument("--output", help="also write results with run info to this JSON file")
+    parser.add_argument("--tracking-sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--sigmas", type=int, nargs="+", default=[1, 3, 9])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--loop-max", type=int, default=10000000,
+                        help="largest size to run the per-frame reference loops at")
+    args = parser.parse_args(argv)
+
+    params = load_params(args.params)
+    rows = BENCHMARKS[args.benchmark](args, params)
+    for row in rows:
+        print(json.dumps(row))
+    if args.output:
+        with open(args.output, 'w') as results_out:
+            json.dump({"info": run_info(), "results": rows}, results_out, indent=4)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,161 +1,395 @@
 import os
+import shutil
 import statistics
 import json
 import numpy as np
-import copy
-from LBO import single_optimize
+import weakref
+from collections import Counter
+from LBO import optimize_batch, optimize_budget, DEFAULT_RATE_MODEL
+
+class FrameStore:
+    # Growable columnar storage for frames, shared by the buffers viewing it
+    # Rows are only ever appended at the end, so windows over existing rows stay valid
+
+    COLUMNS = {"index": np.int64, "value": np.float64, "cost": np.float64, "data_size": np.float64,
+               "anomaly_score": np.float64, "data_ptrs": object, "track_ids": object}
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in FrameStore.COLUMNS.items()}
+        self.windows = weakref.WeakSet()
 
 class Buffer:
     # Class for a buffer of data frames
+    # A buffer is a [start, end) window over a FrameStore, so copy/split/extend share rows instead of copying
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, frame_list=None, msg=None, capacity=None):
+        self.capacity = capacity if capacity is not None else Buffer.INITIAL_CAPACITY
+        self._store = None
+        self._start = 0
+        self._end = 0
+        # Number of frames in the buffer each track ID appears in
+        self.track_counts = Counter()
+        # Directory of really compressed frames, if any
+        self.frames_addr = None
+        # Values LBO decided on, kept by fakeCompress so the buffer can be recompressed later
+        self.lbo_value = None
+        # Frames each frame stands for after collapseDuplicates
+        self.references = None
+
+    def _column(self, name):
+        if self._store is None:
+            return np.empty(0, dtype=FrameStore.COLUMNS[name])
+        return self._store.columns[name][self._start:self._end]
+
+    def _setColumn(self, name, values):
+        # Writes a whole column, detaching first if another buffer views the same rows
+        if self._store is None:
+            return
+        self._detachShared()
+        self._store.columns[name][self._start:self._end] = values
+
+    index = property(lambda self: self._column("index"), lambda self, v: self._setColumn("index", v))
+    value = property(lambda self: self._column("value"), lambda self, v: self._setColumn("value", v))
+    cost = property(lambda self: self._column("cost"), lambda self, v: self._setColumn("cost", v))
+    # Original size of each frame, kept after cost is replaced by the compressed size
+    data_size = property(lambda self: self._column("data_size"), lambda self, v: self._setColumn("data_size", v))
+    anomaly_score = property(lambda self: self._column("anomaly_score"),
+                             lambda self, v: self._setColumn("anomaly_score", v))
+    data_ptrs = property(lambda self: self._column("data_ptrs"), lambda self, v: self._setColumn("data_ptrs", v))
+
+    @property
+    def objects(self):
+        # Distinct track IDs in the buffer
+        return list(self.track_counts)
+
+    def _countTracks(self, store, start, end):
+        # Adds the track IDs of rows [start, end) of store
+        for track_ids in store.columns["track_ids"][start:end]:
+            self.track_counts.update(track_ids)
+
+    def _uncountTracks(self, store, start, end):
+        # Removes the track IDs of rows [start, end) of store
+        track_counts = self.track_counts
+        for track_ids in store.columns["track_ids"][start:end]:
+            for track_id in track_ids:
+                track_counts[track_id] -= 1
+                if track_counts[track_id] == 0:
+                    del track_counts[track_id]
+
+    def _recountTracks(self, source, start, end):
+        # Sets track counts for rows [start, end) of source's store
+        # Starts from source's counts when fewer rows are dropped than kept
+        kept = end - start
+        dropped = source.size() - kept
+        if dropped < kept:
+            store = source._store
+            self.track_counts = Counter(source.track_counts)
+            self._uncountTracks(store, source._start, start)
+            self._uncountTracks(store, end, source._end)
+        else:
+            self.track_counts = Counter()
+            self._countTracks(source._store, start, end)
+
+    def __getstate__(self):
+        # Pickles only the buffer's own rows rather than its whole store
+        state = self.__dict__.copy()
+        del state["_store"], state["_start"], state["_end"]
+        state["columns"] = {name: self._column(name) for name in FrameStore.COLUMNS}
+        return state
+
+    def __setstate__(self, state):
+        columns = state.pop("columns")
+        self.__dict__.update(state)
+        self._store = None
+        self._start = 0
+        self._end = 0
+        n = len(columns["index"])
+        if n > 0:
+            store = FrameStore(n)
+            for name, column in columns.items():
+                store.columns[name][:] = column
+            store.size = n
+            self._attach(store, 0, n)
+
+    def _attach(self, store, start, end):
+        # Points the buffer at rows [start, end) of store
+        if self._store is not None:
+            self._store.windows.discard(self)
+        if store is None or end <= start:
+            store, start, end = None, 0, 0
+        else:
+            store.windows.add(self)
+        self._store = store
+        self._start = start
+        self._end = end
+
+    def _relocate(self, capacity):
+        # Moves the buffer's rows into a new store of its own
+        store = FrameStore(capacity)
+        n = self.size()
+        for name, column in store.columns.items():
+            column[:n] = self._column(name)
+        store.size = n
+        if self._store is not None:
+            self._store.windows.discard(self)
+        store.windows.add(self)
+        self._store = store
+        self._start = 0
+        self._end = n
+
+    def _detachShared(self):
+        # Copies the buffer's rows if any other live buffer views an overlapping window
+        for other in list(self._store.windows):
+            if other is not self and other._start < self._end and self._start < other._end:
+                self._relocate(max(self.size(), 1))
+                return
 
-    def __init__(self, frame_list=None, msg=None):
-        self.data_ptrs = []
-        self.index = []
-        self.value = []
-        self.cost = []
-        self.anomaly_score = []
-        self.objects = []
+    def detach(self):
+        # Moves the buffer's rows into a store of its own, so it can be finalized on another thread
+        # while buffers sharing its old store keep growing
+        if self._store is not None:
+            self._relocate(self.size())
+
+    def _reserve(self, n):
+        # Makes room to append n rows in place at the end of the window
+        if self._store is not None and self._end == self._store.size and \
+           self._store.size + n <= self._store.capacity:
+            return
+        self._relocate(max(2 * (self.size() + n), self.capacity))
+
+    def _appendRows(self, store, start, end):
+        # Appends rows [start, end) of store
+        n = end - start
+        if self.size() == 0:
+            # Share the source rows directly
+            self._attach(store, start, end)
+            return
+        if store is self._store and start == self._end:
+            # Source rows already follow this window in the same store
+            self._end = end
+            return
+        self._reserve(n)
+        for name, column in self._store.columns.items():
+            column[self._end:self._end + n] = store.columns[name][start:end]
+        self._end += n
+        self._store.size = self._end
+
+    def _window(self, slice_from, slice_until):
+        # Converts slice bounds relative to the buffer into absolute store rows
+        start, end, _ = slice(slice_from, slice_until).indices(self.size())
+        return self._start + start, self._start + max(start, end)
 
     def extend(self, new_buffer, extend_from=None, extend_until=None):
         # Appends the frames of new_buffer
-        if not new_buffer or not new_buffer.index[extend_from:extend_until]:
+        if not new_buffer:
+            return
+        start, end = new_buffer._window(extend_from, extend_until)
+        if end <= start:
             return
 
-        self.data_ptrs.extend(new_buffer.data_ptrs[extend_from:extend_until])
-        self.index.extend(new_buffer.index[extend_from:extend_until])
-        self.value.extend(new_buffer.value[extend_from:extend_until])
-        self.cost.extend(new_buffer.cost[extend_from:extend_until])
-        self.anomaly_score.extend(new_buffer.anomaly_score[extend_from:extend_until])
-        self.objects.extend(new_buffer.objects[extend_from:extend_until])
-        self.objects = list(set(self.objects))
+        self._countTracks(new_buffer._store, start, end)
+        self._appendRows(new_buffer._store, start, end)
 
     def copy(self, new_buffer, copy_from=None, copy_until=None):
-        # Copies the frames of new_buffer
-        if not new_buffer or not new_buffer.index[copy_from:copy_until]:
-            self.data_ptrs = []
-            self.index = []
-            self.value = []
-            self.cost = []
-            self.anomaly_score = []
-            self.objects = []
+        # Copies the frames of new_buffer as a view over its rows
+        if not new_buffer:
+            self._attach(None, 0, 0)
+            self.track_counts = Counter()
             return
-
-        self.data_ptrs = new_buffer.data_ptrs[copy_from:copy_until]
-        self.index = new_buffer.index[copy_from:copy_until]
-        self.value = new_buffer.value[copy_from:copy_until]
-        self.cost = new_buffer.cost[copy_from:copy_until]
-        self.anomaly_score = new_buffer.anomaly_score[copy_from:copy_until]
-        self.objects = new_buffer.objects[copy_from:copy_until]
+        start, end = new_buffer._window(copy_from, copy_until)
+        self._recountTracks(new_buffer, start, end)
+        self._attach(new_buffer._store, start, end)
 
     def split(self, split_from=None, split_until=None):
         # Splits the buffer
-        if not self.index[split_from:split_until]:
-            self.data_ptrs = []
-            self.index = []
-            self.value = []
-            self.cost = []
-            self.anomaly_score = []
-            self.objects = []
+        start, end = self._window(split_from, split_until)
+        if end <= start:
+            self._attach(None, 0, 0)
+            self.track_counts = Counter()
             return
 
-        self.data_ptrs = self.data_ptrs[split_from:split_until]
-        self.index = self.index[split_from:split_until]
-        self.value = self.value[split_from:split_until]
-        self.cost = self.cost[split_from:split_until]
-        self.anomaly_score = self.anomaly_score[split_from:split_until]
-        self.objects = self.objects[split_from:split_until]
-        self.objects = list(set(self.objects))
+        self._recountTracks(self, start, end)
+        self._attach(self._store, start, end)
 
     def append(self, new_frame):
         # Appends new_frame
-        self.data_ptrs.append(new_frame.data_ptr)
-        self.index.append(new_frame.index)
-        self.value.append(new_frame.value)
-        self.cost.append(new_frame.cost)
-        self.anomaly_score.append(new_frame.anomaly_score)
-        self.objects += new_frame.objects
-        self.objects = list(set(self.objects))
+        self._reserve(1)
+        row = self._end
+        columns = self._store.columns
+        columns["index"][row] = new_frame.index
+        columns["value"][row] = new_frame.value
+        columns["cost"][row] = new_frame.cost
+        columns["data_size"][row] = new_frame.cost
+        columns["anomaly_score"][row] = new_frame.anomaly_score
+        columns["data_ptrs"][row] = new_frame.data_ptr
+        columns["track_ids"][row] = new_frame.objects
+        self._end += 1
+        self._store.size = self._end
+        self.track_counts.update(new_frame.objects)
+
+    def appendBlock(self, index, value, cost, anomaly_score, data_ptrs, track_ids):
+        # Appends a run of frames given as columns, as append would frame by frame
+        n = len(index)
+        self._reserve(n)
+        row = self._end
+        columns = self._store.columns
+        columns["index"][row:row+n] = index
+        columns["value"][row:row+n] = value
+        columns["cost"][row:row+n] = cost
+        columns["data_size"][row:row+n] = cost
+        columns["anomaly_score"][row:row+n] = anomaly_score
+        columns["data_ptrs"][row:row+n] = data_ptrs
+        track_column = columns["track_ids"]
+        for offset, frame_ids in enumerate(track_ids):
+            track_column[row + offset] = frame_ids
+            self.track_counts.update(frame_ids)
+        self._end += n
+        self._store.size = self._end
 
     def calcSimilarity(self, track_ids):
+        # Fraction of track_ids present in the buffer
         if len(track_ids) == 0:
             return 0.0
-        intersecting = len(list(set(self.objects) & set(track_ids)))
+        track_counts = self.track_counts
+        intersecting = sum(1 for track_id in set(track_ids) if track_id in track_counts)
         return intersecting / len(track_ids)
 
     def filterValue(self, sigma):
         # Applies gaussian filters to values
-        N = len(self.value)
-        filtered_value = copy.deepcopy(self.value)
-        for i, value in enumerate(self.value):
-            if i > 0:
-                if self.value[i] > self.value[i-1]:
-                    mu = i
-                    start_idx = max(mu - 3*sigma, 0)
-                    a = self.value[i] - self.value[i-1]
-                    for j in range(start_idx, mu):
-                        filtered_value[j] = max(filtered_value[j], gaussian(j,a,mu,sigma))
-                elif self.value[i] < self.value[i-1]:
-                    mu = i
-                    end_idx = min(mu + 3*sigma, N)
-                    a = self.value[i-1] - self.value[i]
-                    for j in range(mu, end_idx):
-                        filtered_value[j] = max(filtered_value[j], gaussian(j,a,mu,sigma))
+        # Each rising edge spreads its step over the 3*sigma frames before it, each falling edge over the 3*sigma frames from it
+        value = self.value
+        N = len(value)
+        filtered_value = value.copy()
+        delta = np.diff(value)
+        for edges, offsets in ((np.flatnonzero(delta > 0) + 1, np.arange(-3*sigma, 0)),
+                               (np.flatnonzero(delta < 0) + 1, np.arange(0, 3*sigma))):
+            if edges.size == 0 or offsets.size == 0:
+                continue
+            targets = edges[:,None] + offsets
+            kernels = gaussian(targets, np.abs(delta[edges-1])[:,None], edges[:,None], sigma)
+            in_range = (targets >= 0) & (targets < N)
+            np.maximum.at(filtered_value, targets[in_range], kernels[in_range])
 
         self.value = filtered_value
 
-    def generateDecision(self, eta, zeta):
+    def collapseDuplicates(self, starts):
+        # Keeps only the first frame of each run of near-duplicate frames starting at positions starts,
+        # with the highest value and anomaly score in its run, and records the frames of the rest in references
+        n = self.size()
+        ends = np.append(starts[1:], n)
+        index = self.index
+        self.references = [index[start+1:end].tolist() for start, end in zip(starts, ends)]
+        if len(starts) == n:
+            return
+
+        value = np.maximum.reduceat(self.value, starts)
+        anomaly_score = np.maximum.reduceat(self.anomaly_score, starts)
+        store = FrameStore(len(starts))
+        for name, column in store.columns.items():
+            column[:] = self._column(name)[starts]
+        store.size = len(starts)
+        store.columns["value"][:] = value
+        store.columns["anomaly_score"][:] = anomaly_score
+        self._attach(store, 0, len(starts))
+        self.track_counts = Counter()
+        self._countTracks(store, 0, len(starts))
+
+    def generateDecision(self, eta, zeta, model=DEFAULT_RATE_MODEL, budget=None):
         # Generates the decisions for the buffer using LBO
-        self.decision = []
-        for cost, value in zip(self.cost, self.value):
-            self.decision.append(single_optimize(cost, value, eta, zeta))
+        # Given a byte budget, decisions instead maximize the buffer's value with its estimated compressed size in budget
+        # If even all-zero decisions exceed the budget, they're used anyway as the smallest the buffer gets
+        if budget is not None:
+            self.decision = optimize_budget(self.cost, self.value, budget, model)
+            if self.decision is None:
+                self.decision = np.zeros(self.size())
+        else:
+            self.decision = optimize_batch(self.cost, self.value, eta, zeta, model)
 
-    def fakeCompress(self):
+    def fakeCompress(self, model=DEFAULT_RATE_MODEL):
         # Compress buffer data based on LBO decision
-        a = 0.1083869
-        b = 0.99837249
-        c = 0.02535
-        for i, img_ptr in enumerate(self.data_ptrs):
-            phi = -a*np.log2(1 - b*self.decision[i]) + c
-            self.cost[i] = os.path.getsize(img_ptr) * phi
-            self.value[i] *= self.decision[i]
-
-    def fakeDump(self, path, fifo):
-        # Dumps log to json
+        self.lbo_value = self.value.copy()
+        self.cost = self.data_size * model.phi(self.decision)
+        self.value = self.value * self.decision
+
+    def compress(self, compressor, path):
+        # Re-encodes buffer frames based on LBO decision, recording their compressed sizes as cost
+        self.frames_addr = os.path.join(path, "buffer" + str(self.buffer_index) + "_frames")
+        self.cost = compressor.compress(self.data_ptrs, self.decision, self.frames_addr)
+        self.value = self.value * self.decision
+
+    def fakeDump(self, path, fifo, writer=None):
+        # Dumps log to json, through writer's background thread if given
         name = "fifo_" if fifo else "priority_"
         name += "buffer" + str(self.buffer_index)
 
         self.buffer_cost = self.totalCost()
 
         self.log_addr = os.path.join(path, name + "_log.json")
-        log = {"value":self.value, "cost":self.cost, "frame":self.index, "decision":self.decision}
-        with open(self.log_addr, 'w') as log_out:
-            json.dump(log, log_out)
+        log = {"value":self.value.tolist(), "cost":self.cost.tolist(), "frame":self.index.tolist(),
+               "decision":self.decision.tolist()}
+        if self.references is not None:
+            log["references"] = self.references
+        if self.frames_addr is not None:
+            log["frames_dir"] = self.frames_addr
+        write_log(self.log_addr, log, writer)
 
-    def fakeDrop(self):
+    def fakeDrop(self, writer=None):
         # Drops the buffer
-        os.remove(self.log_addr)
+        drop_logs(self.log_addr, self.frames_addr, writer)
+        self.frames_addr = None
+
+    def dropFrames(self, writer=None):
+        # Deletes really compressed frames, if any
+        if self.frames_addr is not None:
+            if writer is not None:
+                writer.drop(self.frames_addr)
+            else:
+                shutil.rmtree(self.frames_addr, ignore_errors=True)
+            self.frames_addr = None
 
     def maxValue(self):
-        return max(self.value)
+        return float(np.max(self.value))
 
     def totalCost(self):
-        return sum(self.cost)
+        return float(np.sum(self.cost))
 
     def totalValue(self):
-        return sum(self.value)
+        return float(np.sum(self.value))
 
     def setBufferValue(self, inflation_factor):
-        self.buffer_value = (inflation_factor ** self.buffer_index) * max(self.value)
+        self.buffer_value = (inflation_factor ** self.buffer_index) * self.maxValue()
 
     def setBufferIndex(self, index):
         self.buffer_index = index
 
     def size(self):
-        return len(self.index)
+        return self._end - self._start
+
+    def __len__(self):
+        return self.size()
+
+def write_log(log_addr, log, writer=None):
+    # Writes a buffer log as json, through writer if given
+    if writer is not None:
+        writer.submit(log_addr, log)
+        return
+    with open(log_addr, 'w') as log_out:
+        json.dump(log, log_out)
 
-    def __lt__(self, other):
-        # Less than comparator for priorityq
-        return self.buffer_value < other.buffer_value
+def drop_logs(log_addr, frames_addr=None, writer=None):
+    # Deletes a dumped buffer's log and really compressed frames, through writer if given
+    if writer is not None:
+        writer.drop(log_addr, frames_addr)
+        return
+    # A resumed run can drop a log that was already deleted after its checkpoint
+    if os.path.exists(log_addr):
+        os.remove(log_addr)
+    if frames_addr is not None:
+        shutil.rmtree(frames_addr, ignore_errors=True)
 
 def gaussian(x,a,mu,sigma):
     return a*np.exp(-((x-mu)**2)/(2*sigma**2))
@@ -0,0 +1,416 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from DMM import DMM
+from DataFrame import DataFrame
+from PriorityQueue import PriorityQ, get_eviction_policy
+from buffer import Buffer
+from ValueEngine import ValueEngine, normalize_vad
+from LBO import get_rate_model
+from FrameManifest import FrameManifest
+from TrackingOutput import load_tracking
+from Metrics import Metrics
+from Compression import ImageCompressor
+from BufferWriter import make_writer
+from sbb import RESULTS_PATH, finalize_buffer, reset_results_dir
+from Params import load_params, with_defaults
+
+logger = logging.getLogger(__name__)
+
+# A watched directory gets one <name>.json sidecar per frame, holding the frame's "vad" score, "oad" scores and
+# "tracking" IDs, and its image path as "frame", by default <name> in the same directory
+# Sidecars are read in name order once they exist, so they should be renamed into place once complete
+# and named so that they sort in arrival order. A file named END ends the stream
+SIDECAR_SUFFIX = ".json"
+END_MARKER = "END"
+
+class LiveFrame:
+    # A frame and its upstream outputs as they arrive, stamped with the arrival time
+    __slots__ = ("index", "data_ptr", "size", "vad_score", "oad_scores", "track_ids", "arrival")
+
+    def __init__(self, data_ptr, vad_score, oad_scores, track_ids, size=None):
+        self.index = None
+        self.data_ptr = data_ptr
+        self.size = size if size is not None else os.path.getsize(data_ptr)
+        self.vad_score = vad_score
+        self.oad_scores = oad_scores
+        self.track_ids = track_ids
+        self.arrival = time.perf_counter()
+
+    @classmethod
+    def fromMessage(cls, message, frame_dir=None):
+        # Builds a frame from a sidecar or socket message
+        data_ptr = message["frame"]
+        if frame_dir is not None:
+            data_ptr = os.path.join(frame_dir, data_ptr)
+        return cls(data_ptr, message["vad"], message["oad"], message["tracking"], message.get("size"))
+
+class DirectorySource:
+    # Source of frames written to a watched directory, polled every poll_interval seconds
+    # Sidecars are taken once they sort after every sidecar read before the last poll. A sidecar renamed into
+    # place while the directory is being listed can be missed, but then shows up in the next listing, so only
+    # the names read in the last poll need remembering. The directory is only listed again once its mtime
+    # changes, or while that's within MTIME_SLACK seconds of now in case the filesystem's clock is coarse
+
+    MTIME_SLACK = 2.0
+
+    def __init__(self, watch_path, poll_interval=0.05):
+        self.watch_path = watch_path
+        self.poll_interval = poll_interval
+
+    def scan(self, after, recent, listed_mtime):
+        # Returns the sidecars sorting after after that aren't in recent, in name order, the directory mtime
+        # they were listed at, and whether the stream had ended before they were listed
+        ended = os.path.exists(os.path.join(self.watch_path, END_MARKER))
+        stat = os.stat(self.watch_path)
+        if stat.st_mtime_ns == listed_mtime and time.time() - stat.st_mtime > DirectorySource.MTIME_SLACK:
+            return [], listed_mtime, ended
+        with os.scandir(self.watch_path) as it:
+            names = sorted(entry.name for entry in it if entry.name.endswith(SIDECAR_SUFFIX) and
+                           (after is None or entry.name > after) and entry.name not in recent)
+        return names, stat.st_mtime_ns, ended
+
+    async def run(self, emit):
+        loop = asyncio.get_running_loop()
+        os.makedirs(self.watch_path, exist_ok=True)
+        after = None
+        recent = set()
+        listed_mtime = None
+        while True:
+            names, listed_mtime, ended = await loop.run_in_executor(None, self.scan, after, recent, listed_mtime)
+            for name in names:
+                with open(os.path.join(self.watch_path, name)) as sidecar_in:
+                    message = json.load(sidecar_in)
+                message.setdefault("frame", name[:-len(SIDECAR_SUFFIX)])
+                await emit(LiveFrame.fromMessage(message, self.watch_path))
+            if ended:
+                return
+            if recent:
+                after = max(recent)
+            recent = set(names)
+            await asyncio.sleep(self.poll_interval)
+
+def parse_address(address):
+    # "host:port" is a TCP address, anything else a Unix socket path
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return address, None
+
+class SocketSource:
+    # Source of frames sent over a local socket as newline-delimited JSON messages with a "frame" path,
+    # "vad", "oad" and "tracking", by a single producer. The stream ends when the producer disconnects
+    # Lines are only read as fast as frames are taken, so a slow pipeline pushes back on the producer
+
+    def __init__(self, address):
+        self.address = address
+
+    async def run(self, emit):
+        done = asyncio.get_running_loop().create_future()
+
+        async def serve(reader, writer):
+            if done.done():
+                writer.close()
+                return
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    await emit(LiveFrame.fromMessage(json.loads(line)))
+            except BaseException as error:
+                if not done.done():
+                    done.set_exception(error)
+                raise
+            finally:
+                writer.close()
+            if not done.done():
+                done.set_result(None)
+
+        host, port = parse_address(self.address)
+        if port is None:
+            server = await asyncio.start_unix_server(serve, path=host)
+        else:
+            server = await asyncio.start_server(serve, host, port)
+        logger.info("Listening for frames on %s", self.address)
+        async with server:
+            await done
+
+class LiveSBB:
+    # Class for running the SBB on frames as they arrive
+    # Ingest, value computation, DMM stepping, buffer finalization and output writing run as separate stages
+    # connected by bounded queues, so a slow stage makes the ones before it wait instead of queueing without bound
+    # Finalization runs on its own thread, on buffers detached from the rows the DMM keeps appending to
+
+    def __init__(self, source, params=None, results_path=RESULTS_PATH):
+        """
+        @param source: DirectorySource, SocketSource or anything with an async run(emit) calling emit for each frame
+        @param dict params: SBB parameters, read from params.json if not given
+        @param str results_path: output directory for buffer logs
+        """
+        self.source = source
+        self.params = with_defaults(params) if params is not None else load_params()
+        self.results_path = results_path
+        self.metrics = Metrics()
+        self.queue_size = self.params["live_queue_size"]
+
+        self.dmm = DMM(major_buffer_max=self.params["major_buffer_max"],
+                       wait_buffer_max=self.params["wait_buffer_max"],
+                       pre_buffer_min=self.params["pre_buffer_min"],
+                       similarity_threshold=self.params["similarity_threshold"],
+                       value_threshold=self.params["value_threshold"],
+                       metrics=self.metrics)
+        self.precursor = Buffer()
+
+        # VAD scores can't be normalized over a recording that hasn't happened yet,
+        # so they are normalized with vad_range if given and taken as they are otherwise
+        self.vad_range = self.params["vad_range"]
+        if self.params["dedup"]:
+            logger.warning("Frame deduplication needs the whole frame directory and is skipped on live feeds")
+        self.value_engine = ValueEngine(self.params)
+        self.rate_model = get_rate_model(self.params["rate_model"])
+        self.compressor = None
+        if self.params["compression_mode"] == "real":
+            self.compressor = ImageCompressor(self.params["compression_workers"], *self.params["compression_quality"],
+                                              executor=self.params["compression_executor"])
+
+        reset_results_dir(self.results_path)
+
+        self.writer = make_writer(self.params, self.results_path)
+        self.priorityq = PriorityQ(self.params["max_memory_mb"], self.params["inflation_factor"],
+                                   self.params["fifo"], metrics=self.metrics, writer=self.writer,
+                                   policy=get_eviction_policy(self.params, self.rate_model))
+
+        self.num_frames = 0
+        self.buffer_index = 0
+        # Arrival time of each frame not yet in a stored buffer
+        self.arrivals = {}
+
+    async def put(self, queue, item, stage):
+        # Puts item on the next stage's queue, counting the times stage had to wait for room
+        if queue.full():
+            self.metrics.incr("live_stalls", stage=stage)
+        await queue.put(item)
+
+    async def run(self):
+        frames = asyncio.Queue(self.queue_size)
+        values = asyncio.Queue(self.queue_size)
+        buffers = asyncio.Queue(self.queue_size)
+        finalized = asyncio.Queue(self.queue_size)
+        stages = [asyncio.ensure_future(stage) for stage in
+                  (self.ingestStage(frames), self.valueStage(frames, values), self.dmmStage(values, buffers),
+                   self.finalizeStage(buffers, finalized), self.writeStage(finalized))]
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            for stage in stages:
+                stage.cancel()
+            raise
+        finally:
+            if self.compressor is not None:
+                self.compressor.close()
+            if self.writer is not None:
+                with self.metrics.timer("writer_flush"):
+                    self.writer.close(self.metrics)
+        self.metrics.incr("frames", self.num_frames)
+        logger.info("Processed %d frames", self.num_frames)
+
+    async def ingestStage(self, frames):
+        # Numbers frames in arrival order
+        async def emit(frame):
+            frame.index = self.num_frames
+            self.num_frames += 1
+            self.arrivals[frame.index] = frame.arrival
+            await self.put(frames, frame, "ingest")
+
+        await self.source.run(emit)
+        await frames.put(None)
+
+    async def valueStage(self, frames, values):
+        # Computes values for every frame waiting at once
+        while True:
+            batch = [await frames.get()]
+            while batch[-1] is not None and not frames.empty():
+                batch.append(frames.get_nowait())
+            ended = batch[-1] is None
+            if ended:
+                batch.pop()
+
+            if batch:
+                with self.metrics.timer("value_computation"):
+                    vad_scores = np.array([frame.vad_score for frame in batch], dtype=float)
+                    if self.vad_range is not None:
+                        vad_scores = normalize_vad(vad_scores, self.vad_range)
+                    frame_values = self.value_engine.compute(vad_scores,
+                                                             np.array([frame.oad_scores for frame in batch]))
+                for frame, value, vad_score in zip(batch, frame_values, vad_scores):
+                    await self.put(values, DataFrame(frame.data_ptr, frame.index, value, vad_score, frame.track_ids,
+                                                     cost=frame.size), "value")
+            if ended:
+                await values.put(None)
+                return
+
+    async def dmmStage(self, values, buffers):
+        while True:
+            frame = await values.get()
+            if frame is None:
+                break
+            start = time.perf_counter()
+            terminated = self.stepFrame(frame)
+            self.metrics.addTime("dmm_step", time.perf_counter() - start)
+            if terminated is not None:
+                await self.put(buffers, terminated, "dmm")
+            self.metrics.observe("frame_latency_seconds", time.perf_counter() - self.arrivals[frame.index],
+                                 stage="dmm")
+
+        if self.dmm.started:
+            self.dmm.major_buffer.extend(self.dmm.wait_buffer)
+            if self.dmm.major_buffer.size() > 0:
+                await buffers.put(self.takeBuffer())
+        await buffers.put(None)
+
+    def stepFrame(self, frame):
+        # Runs one frame through the precursor or the DMM, returning the buffer it terminated, if any
+        i = frame.index
+        if i < self.dmm.PRE_BUFFER_MIN:
+            self.precursor.append(frame)
+            return None
+        elif i == self.dmm.PRE_BUFFER_MIN:
+            logger.info("Starting DMM")
+            self.dmm.start(self.precursor)
+
+        terminated = None
+        while True:
+            if self.dmm.state == DMM.State.TERMINATE:
+                terminated = self.takeBuffer()
+                input = self.dmm.reset(frame)
+            else:
+                sim = self.dmm.major_buffer.calcSimilarity(frame.objects)
+                input = self.dmm.compute_input(frame, sim)
+            action = self.dmm.update_state(input)
+            if self.dmm.run_action(frame, action):
+                return terminated
+
+    def takeBuffer(self):
+        # Numbers the major buffer and detaches it for finalization
+        buffer = self.dmm.major_buffer
+        buffer.setBufferIndex(self.buffer_index)
+        self.buffer_index += 1
+        buffer.detach()
+        return buffer
+
+    async def finalizeStage(self, buffers, finalized):
+        # Finalizes buffers in order on one thread, so DMM stepping carries on meanwhile
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(1, thread_name_prefix="LiveFinalize") as executor:
+            while True:
+                buffer = await buffers.get()
+                if buffer is None:
+                    break
+                # Finalization records into metrics of its own, merged here so only the loop thread touches self.metrics
+                buffer_metrics = Metrics()
+                await loop.run_in_executor(executor, finalize_buffer, buffer, self.params, self.rate_model,
+                                           self.compressor, self.results_path, buffer_metrics)
+                self.metrics.merge(buffer_metrics)
+                await self.put(finalized, buffer, "finalize")
+        await finalized.put(None)
+
+    async def writeStage(self, finalized):
+        # Pushes finalized buffers into the priority queue, which writes their logs
+        while True:
+            buffer = await finalized.get()
+            if buffer is None:
+                return
+            with self.metrics.timer("push"):
+                self.priorityq.fakePush(buffer, self.results_path)
+            now = time.perf_counter()
+            for i in buffer.index.tolist():
+                arrival = self.arrivals.pop(i, None)
+                if arrival is not None:
+                    self.metrics.observe("frame_latency_seconds", now - arrival, stage="stored")
+
+async def replay(frame_path, vad_path, oad_path, tracking_path, target, fps=0.0, to_socket=False):
+    # Feeds a recorded run to a watched directory or a socket, at fps frames per second or as fast as possible
+    manifest = FrameManifest.load(frame_path)
+    vad_scores = np.load(vad_path, mmap_mode="r")
+    oad_scores = np.load(oad_path, mmap_mode="r")
+    tracking_output = load_tracking(tracking_path)
+
+    writer = None
+    if to_socket:
+        host, port = parse_address(target)
+        if port is None:
+            _, writer = await asyncio.open_unix_connection(host)
+        else:
+            _, writer = await asyncio.open_connection(host, port)
+    else:
+        os.makedirs(target, exist_ok=True)
+
+    start = time.perf_counter()
+    for i in range(len(manifest)):
+        if fps:
+            await asyncio.sleep(max(start + i / fps - time.perf_counter(), 0))
+        message = {"frame": os.path.abspath(manifest.path(i)), "size": int(manifest.sizes[i]),
+                   "vad": float(vad_scores[i]), "oad": np.asarray(oad_scores[i]).tolist(),
+                   "tracking": np.asarray(tracking_output[i]).tolist()}
+        if writer is not None:
+            writer.write((json.dumps(message) + "\n").encode())
+            await writer.drain()
+        else:
+            sidecar_path = os.path.join(target, "frame%09d%s" % (i, SIDECAR_SUFFIX))
+            with open(sidecar_path + ".tmp", 'w') as sidecar_out:
+                json.dump(message, sidecar_out)
+            os.replace(sidecar_path + ".tmp", sidecar_path)
+
+    if writer is not None:
+        writer.close()
+        await writer.wait_closed()
+    else:
+        open(os.path.join(target, END_MARKER), 'w').close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Smart Black Box on a live feed")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    watch = subparsers.add_parser("watch", help="process frames written to a directory")
+    watch.add_argument("watch_dir")
+    socket = subparsers.add_parser("socket", help="process frames sent to a socket")
+    socket.add_argument("address", help="host:port, or a Unix socket path")
+    for mode in (watch, socket):
+        mode.add_argument("--params", default="params.json")
+        mode.add_argument("--output", default=RESULTS_PATH, help="directory for buffer logs")
+        mode.add_argument("--log-level", default="WARNING")
+        mode.add_argument("--metrics", help="write run metrics here, as Prometheus text for .prom/.txt and JSON otherwise")
+    feed = subparsers.add_parser("replay", help="feed a recording to a watched directory or socket")
+    feed.add_argument("frames_dir")
+    feed.add_argument("vad_scores")
+    feed.add_argument("oad_scores")
+    feed.add_argument("obj_tracking_output")
+    feed.add_argument("target", help="directory to write sidecars to, or with --socket the address to send to")
+    feed.add_argument("--socket", action="store_true")
+    feed.add_argument("--fps", type=float, default=0.0, help="frames per second, as fast as possible by default")
+    args = parser.parse_args(argv)
+
+    if args.mode == "replay":
+        asyncio.run(replay(args.frames_dir, args.vad_scores, args.oad_scores, args.obj_tracking_output,
+                           args.target, args.fps, args.socket))
+        return
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(message)s")
+    params = load_params(args.params)
+    if args.mode == "watch":
+        source = DirectorySource(args.watch_dir, params["live_poll_interval"])
+    else:
+        source = SocketSource(args.address)
+    live_sbb = LiveSBB(source, params=params, results_path=args.output)
+    asyncio.run(live_sbb.run())
+    if args.metrics:
+        live_sbb.metrics.export(args.metrics)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,120 +1,344 @@
 import os
 import sys
-import json
+import time
 import shutil
+import logging
+import argparse
 import statistics
 import numpy as np
-from DMM import DMM
+from DMM import DMM, run_lengths
 from DataFrame import DataFrame
-from IBCC import IBCC
-from PriorityQueue import PriorityQ
+from PriorityQueue import PriorityQ, get_eviction_policy
 from buffer import Buffer
+from ValueEngine import ValueEngine, normalize_vad, scan_vad_range
+from LBO import get_rate_model, lbo_budget
+from FrameManifest import FrameManifest
+from TrackingOutput import CSRTracking, load_tracking
+from TrackIndex import TrackIndex
+from FrameHash import FrameHashes
+from Metrics import Metrics
+from Compression import ImageCompressor
+from BufferWriter import make_writer
+from Checkpoint import save_state, save_values, has_values, load_state, load_values, remove_checkpoint
+from Params import load_params, with_defaults
+
+logger = logging.getLogger(__name__)
 
 RESULTS_PATH = "sbb_output"
 
+def reset_results_dir(results_path):
+    # Empties results_path for a fresh run, creating it if it doesn't exist
+    try:
+        shutil.rmtree(results_path)
+    except FileNotFoundError:
+        pass
+    os.makedirs(results_path)
+
 class SingleSBB:
 
-    def __init__(self, frame_path, vad_path, oad_path, tracking_path):
+    def __init__(self, frame_path, vad_path, oad_path, tracking_path, params=None, results_path=RESULTS_PATH,
+                 resume=False, inputs=None):
+        """
+        @param dict inputs: preloaded "manifest", normalized "vad_scores", "data_values", "tracking" and optionally
+                            "track_index" and "frame_hashes" to use instead of loading them from the paths,
+                            e.g. shared between the runs of a sweep
+        """
         self.frame_addr = frame_path
-        self.frames = [os.path.join(frame_path, name) for name in sorted(os.listdir(frame_path))]
-        self.params = json.load(open("params.json"))
+        self.manifest = inputs["manifest"] if inputs is not None else FrameManifest.load(frame_path)
+        self.params = with_defaults(params) if params is not None else load_params()
+        self.results_path = results_path
+        self.metrics = Metrics()
+
+        # A resumed run continues from the last checkpoint in results_path instead of starting over
+        self.checkpoint_interval = self.params["checkpoint_interval"]
+        checkpoint = load_state(self.results_path) if resume else None
+        if resume and checkpoint is None:
+            logger.warning("No checkpoint in %s, starting from the first frame", self.results_path)
 
         self.dmm = DMM(major_buffer_max=self.params["major_buffer_max"],
                        wait_buffer_max=self.params["wait_buffer_max"],
                        pre_buffer_min=self.params["pre_buffer_min"],
                        similarity_threshold=self.params["similarity_threshold"],
-                       value_threshold=self.params["value_threshold"])
+                       value_threshold=self.params["value_threshold"],
+                       metrics=self.metrics)
         self.precursor = Buffer()
 
-        self.ibcc = IBCC(self.params["confusion_prior_init"],self.params["class_prob_prior_init"])
+        self.value_engine = ValueEngine(self.params)
+        self.rate_model = get_rate_model(self.params["rate_model"])
+        # Real compression re-encodes frames, fake compression only estimates their size with the rate model
+        self.compressor = None
+        if self.params["compression_mode"] == "real":
+            self.compressor = ImageCompressor(self.params["compression_workers"], *self.params["compression_quality"],
+                                              executor=self.params["compression_executor"])
 
-        self.vad_scores = np.load(vad_path)
-        # Normalize VAD scores
-        self.vad_scores -= np.min(self.vad_scores)
-        self.vad_scores /= (np.max(self.vad_scores) - np.min(self.vad_scores))
+        # In streaming mode scores stay memory-mapped and values are computed block by block during run()
+        self.streaming = bool(self.params["streaming"]) and inputs is None
+        if inputs is not None:
+            self.vad_scores = inputs["vad_scores"]
+            self.data_values = inputs["data_values"]
+            self.tracking_output = inputs["tracking"]
+        else:
+            mmap_mode = "r" if self.streaming else None
+            self.vad_scores = np.load(vad_path, mmap_mode=mmap_mode)
+            self.oad_scores = np.load(oad_path, mmap_mode=mmap_mode)
+            self.tracking_output = load_tracking(tracking_path)
+            if self.streaming and not isinstance(self.tracking_output, CSRTracking):
+                logger.warning("Pickled tracking output is loaded whole, convert it to CSR to stream it from disk")
 
-        self.oad_scores = np.load(oad_path)
-        self.tracking_output = np.load(tracking_path, allow_pickle=True)
+            if self.streaming:
+                self.vad_range = checkpoint["vad_range"] if checkpoint is not None else self.params["vad_range"]
+                if self.vad_range is None:
+                    self.vad_range = scan_vad_range(self.vad_scores, self.params["stream_block_size"])
+                self.data_values = None
+            elif checkpoint is not None:
+                self.vad_scores, self.data_values = load_values(self.results_path)
+            else:
+                with self.metrics.timer("value_computation"):
+                    self.vad_scores = normalize_vad(self.vad_scores)
+                    self.data_values = self.value_engine.compute(self.vad_scores, self.oad_scores)
 
-        self.data_values = np.zeros(self.vad_scores.shape)
-        for i in range(len(self.vad_scores)):
-            vad_score = self.vad_scores[i]
-            self.data_values[i] = self.calcValue(self.oad_scores[i], vad_score)
+        # With a track index, bulk stepping also carries buffering runs through low-value frames similar to the buffer
+        # Nothing else reads it and it grows with the recording, so it's skipped without bulk stepping or when streaming
+        self.track_index = None
+        if self.params["track_index"] and self.params["bulk_stepping"] and not self.streaming:
+            if inputs is not None:
+                self.track_index = inputs.get("track_index")
+            if self.track_index is None:
+                with self.metrics.timer("track_index"):
+                    if inputs is not None:
+                        self.track_index = TrackIndex.fromTracking(self.tracking_output)
+                    else:
+                        self.track_index = TrackIndex.load(tracking_path, self.tracking_output)
+
+        # With dedup, runs of near-duplicate frames in each buffer are collapsed into their first frame
+        self.frame_hashes = None
+        if self.params["dedup"]:
+            if self.params["log_backend"] != "json":
+                raise ValueError("Frame deduplication needs the json log backend to record references")
+            if inputs is not None:
+                self.frame_hashes = inputs.get("frame_hashes")
+            if self.frame_hashes is None:
+                with self.metrics.timer("frame_hashes"):
+                    self.frame_hashes = FrameHashes.load(self.manifest, self.params["dedup_workers"])
 
         self.buffer_index = 0
+        self.next_frame = 0
 
-        self.priorityq = PriorityQ(self.params["max_memory_mb"], self.params["inflation_factor"],
-                                   self.params["fifo"])
+        if checkpoint is None:
+            reset_results_dir(self.results_path)
 
-        try:
-            os.makedirs(RESULTS_PATH)
-        except:
-            shutil.rmtree(RESULTS_PATH)
-            os.makedirs(RESULTS_PATH)
+        # Buffer logs go to JSON files or a segment store, on a background thread unless async_writer is off
+        self.writer = make_writer(self.params, self.results_path)
+        self.priorityq = PriorityQ(self.params["max_memory_mb"], self.params["inflation_factor"],
+                                   self.params["fifo"], metrics=self.metrics, writer=self.writer,
+                                   policy=get_eviction_policy(self.params, self.rate_model))
+        if checkpoint is not None:
+            self.restoreCheckpoint(checkpoint)
 
     def calcValue(self, oad_scores, vad_score):
-        # Calculates value from VAR and OAD
-        if self.params["value_type"] == "ibcc":
-            probs = {}
-            probs["VAD"] = [1-vad_score, vad_score]
-            probs["OAD"] = [oad_scores[0], 1-oad_scores[0]]
-            value = self.ibcc.inferVB(probs)[1]
-        elif self.params["value_type"] == "oad":
-            value = np.sum(np.multiply(np.array(self.params["class_values"]), oad_scores[1:]))
-        elif self.params["value_type"] == "hybrid":
-            value = self.params["hybrid_value_alpha"] * np.sum(np.multiply(np.array(self.params["class_values"]), oad_scores[1:]))
-            value += self.params["hybrid_value_beta"] * vad_score
-        else:
-            value = vad_score
+        # Calculates value from VAD and OAD for a single frame
+        return self.value_engine.computeFrame(oad_scores, vad_score)
+
+    def valueBlocks(self, first=0):
+        # Yields (start, vad_scores, values) for consecutive blocks of frames from frame first
+        num_frames = len(self.manifest)
+        if not self.streaming:
+            yield first, self.vad_scores[first:num_frames], self.data_values[first:num_frames]
+            return
+
+        # Blocks stay aligned to block_size when starting mid-recording, so values match a run from the start bit for bit
+        block_size = self.params["stream_block_size"]
+        for start in range(first - first % block_size, num_frames, block_size):
+            end = min(start + block_size, num_frames)
+            with self.metrics.timer("value_computation"):
+                vad_scores = normalize_vad(self.vad_scores[start:end], self.vad_range)
+                values = self.value_engine.compute(vad_scores, self.oad_scores[start:end])
+            skip = max(first - start, 0)
+            yield start + skip, vad_scores[skip:], values[skip:]
+
+    def saveCheckpoint(self, next_frame):
+        # Checkpoints everything needed to continue from next_frame, once the buffer logs so far are written
+        with self.metrics.timer("checkpoint"):
+            if self.writer is not None:
+                self.writer.flush()
+            if not self.streaming and not has_values(self.results_path):
+                save_values(self.results_path, self.vad_scores, self.data_values)
+            save_state(self.results_path, {"next_frame": next_frame, "dmm": self.dmm, "precursor": self.precursor,
+                                           "buffer_index": self.buffer_index, "priorityq": self.priorityq,
+                                           "metrics": self.metrics,
+                                           "vad_range": self.vad_range if self.streaming else None})
+        logger.info("Checkpointed before frame %d", next_frame)
+
+    def restoreCheckpoint(self, checkpoint):
+        self.next_frame = checkpoint["next_frame"]
+        self.dmm = checkpoint["dmm"]
+        self.precursor = checkpoint["precursor"]
+        self.buffer_index = checkpoint["buffer_index"]
+        self.metrics = checkpoint["metrics"]
+        self.priorityq = checkpoint["priorityq"]
+        self.priorityq.writer = self.writer
+        logger.info("Resuming from frame %d", self.next_frame)
+
+    def stepFrame(self, frame):
+        # Runs one frame through the precursor or the DMM
+        i = frame.index
+        logger.debug("Frame %d", i)
 
-        return value
+        # Fill initial precursor before starting DMM
+        if i < self.dmm.PRE_BUFFER_MIN:
+            self.precursor.append(frame)
+            logger.debug("Precursor size: %d", self.precursor.size())
+            return
+        elif i == self.dmm.PRE_BUFFER_MIN:
+            logger.info("Starting DMM")
+            self.dmm.start(self.precursor)
+
+        # Loop DMM until the frame is resolved
+        while True:
+            if self.dmm.state == DMM.State.TERMINATE:
+                self.pushBuffer()
+                input = self.dmm.reset(frame)
+            else:
+                sim = self.dmm.major_buffer.calcSimilarity(frame.objects)
+                input = self.dmm.compute_input(frame, sim)
+            action = self.dmm.update_state(input)
+            resolved = self.dmm.run_action(frame, action)
+            if resolved:
+                break
+
+    def bufferingRun(self, first, values):
+        # Number of frames from first, with the given values, that keep the DMM buffering:
+        # high-value frames, and low-value frames similar enough to the major buffer they extend
+        # The major buffer always holds the frames from its first up to the frame before, so similarities are
+        # range queries on the track index, made in chunks that double while every frame is kept
+        room = min(self.dmm.MAJOR_BUFFER_MAX - self.dmm.major_buffer.size(), len(values))
+        buffer_start = self.dmm.major_buffer.index[0]
+        run = 0
+        chunk = 64
+        while run < room:
+            end = min(run + chunk, room)
+            frames = np.arange(first + run, first + end)
+            keep = values[run:end] > self.dmm.VALUE_THRESHOLD
+            low = ~keep
+            keep[low] = self.track_index.similarities(frames[low], buffer_start, frames[low] - 1) > \
+                self.dmm.SIMILARITY_THRESHOLD
+            kept = len(keep) if keep.all() else int(np.argmin(keep))
+            run += kept
+            if run < end:
+                break
+            chunk *= 2
+        return run
+
+    def stepRun(self, first, count, action, vad_scores, values):
+        # Runs count frames from first that the DMM takes through the same action in one step
+        logger.debug("Frames %d to %d", first, first + count - 1)
+        self.dmm.run_bulk(action, np.arange(first, first + count), values, self.manifest.sizes[first:first+count],
+                          vad_scores, [self.manifest.path(i) for i in range(first, first + count)],
+                          [self.tracking_output[i] for i in range(first, first + count)])
 
     def run(self):
-        for i, img_ptr in enumerate(self.frames):
-            print("Frame {}".format(i))
-
-            frame = DataFrame(img_ptr, i, self.data_values[i], self.vad_scores[i], self.tracking_output[i])
-            # Fill initial precursor before starting DMM
-            if i < self.dmm.PRE_BUFFER_MIN:
-                self.precursor.append(frame)
-                print("Precursor size: " + str(self.precursor.size()) + '\n')
-                continue
-            elif i == self.dmm.PRE_BUFFER_MIN:
-                print("Starting DMM")
-                self.dmm.start(self.precursor)
-
-            # Loop DMM until the frame is resolved
-            while True:
-                if self.dmm.state == DMM.State.TERMINATE:
-                    self.pushBuffer()
-                    input = self.dmm.reset(frame)
+        run_start = time.perf_counter()
+        stage_time = {stage: self.metrics.timers.get(stage, 0.0)
+                      for stage in ("value_computation", "push", "checkpoint")}
+        num_frames = 0
+        # With bulk stepping, runs of frames the DMM would take through the same self-transition are applied at once
+        bulk_stepping = bool(self.params["bulk_stepping"])
+        if self.checkpoint_interval:
+            next_checkpoint = (self.next_frame // self.checkpoint_interval + 1) * self.checkpoint_interval
+
+        for start, vad_scores, values in self.valueBlocks(self.next_frame):
+            if bulk_stepping:
+                low_runs = run_lengths(values <= self.dmm.VALUE_THRESHOLD)
+                high_runs = run_lengths(values > self.dmm.VALUE_THRESHOLD)
+            offset = 0
+            while offset < len(values):
+                i = start + offset
+                count = 0
+                if bulk_stepping and self.dmm.started:
+                    high_run = high_runs[offset]
+                    if self.track_index is not None and self.dmm.state == DMM.State.BUFFERING:
+                        high_run = self.bufferingRun(i, values[offset:])
+                    count, action = self.dmm.run_length(low_runs[offset], high_run)
+                if count > 1:
+                    self.stepRun(i, count, action, vad_scores[offset:offset+count], values[offset:offset+count])
                 else:
-                    sim = self.dmm.major_buffer.calcSimilarity(frame.objects)
-                    input = self.dmm.compute_input(frame, sim)
-                action = self.dmm.update_state(input)
-                resolved = self.dmm.run_action(frame, action)
-                if resolved:
-                    break
+                    count = 1
+                    self.stepFrame(DataFrame(self.manifest.path(i), i, values[offset], vad_scores[offset],
+                                             self.tracking_output[i], cost=self.manifest.sizes[i]))
+                offset += count
+                num_frames += count
+
+                if self.checkpoint_interval and i + count >= next_checkpoint:
+                    self.saveCheckpoint(i + count)
+                    next_checkpoint = ((i + count) // self.checkpoint_interval + 1) * self.checkpoint_interval
 
         if self.dmm.started:
             self.dmm.major_buffer.extend(self.dmm.wait_buffer)
             if self.dmm.major_buffer.size() > 0:
                 self.pushBuffer()
+        if self.compressor is not None:
+            self.compressor.close()
+        if self.writer is not None:
+            with self.metrics.timer("writer_flush"):
+                self.writer.close(self.metrics)
+        remove_checkpoint(self.results_path)
+
+        # DMM stepping is the run time not spent computing values, finalizing buffers or checkpointing
+        run_time = time.perf_counter() - run_start
+        other_time = sum(self.metrics.timers.get(stage, 0.0) - seconds for stage, seconds in stage_time.items())
+        self.metrics.addTime("dmm_step", run_time - other_time, num_frames)
+        self.metrics.incr("frames", num_frames)
+        logger.info("Processed %d frames in %.3f s", num_frames, run_time)
 
     def pushBuffer(self):
-        buffer = self.dmm.major_buffer
-        buffer.setBufferIndex(self.buffer_index)
-        self.buffer_index += 1
+        with self.metrics.timer("push"):
+            buffer = self.dmm.major_buffer
+            buffer.setBufferIndex(self.buffer_index)
+            self.buffer_index += 1
 
-        buffer.filterValue(self.params["filter_sigma"])
-        buffer.generateDecision(self.params["eta"], self.params["zeta"])
-        buffer.fakeCompress()
+            finalize_buffer(buffer, self.params, self.rate_model, self.compressor, self.results_path, self.metrics,
+                            self.frame_hashes)
+            self.priorityq.fakePush(buffer, self.results_path)
 
-        self.priorityq.fakePush(buffer, RESULTS_PATH)
+def finalize_buffer(buffer, params, rate_model, compressor, results_path, metrics, frame_hashes=None):
+    # Filters a terminated buffer's values, runs LBO on them and compresses it, really or with the rate model
+    # Given frame hashes, near-duplicate frames are collapsed after filtering so LBO and compression skip them
+    with metrics.timer("filter_value"):
+        buffer.filterValue(params["filter_sigma"])
+    if frame_hashes is not None:
+        with metrics.timer("dedup"):
+            num_frames = buffer.size()
+            buffer.collapseDuplicates(frame_hashes.runs(buffer.index, params["dedup_max_distance"]))
+        metrics.incr("frames_deduplicated", num_frames - buffer.size())
+    with metrics.timer("lbo"):
+        buffer.generateDecision(params["eta"], params["zeta"], rate_model, lbo_budget(params))
+    with metrics.timer("compression"):
+        if compressor is not None:
+            buffer.compress(compressor, results_path)
+        else:
+            buffer.fakeCompress(rate_model)
 
-if __name__ == "__main__":
-    if len(sys.argv) != 5:
-        print("Error! Usage is: python3 sbb.py <frames_dir> <vad_scores> <oad_scores> <obj_tracking_output>")
-        exit()
-    sbb = SingleSBB(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+def main(argv):
+    parser = argparse.ArgumentParser(description="Offline Smart Black Box")
+    parser.add_argument("frames_dir")
+    parser.add_argument("vad_scores")
+    parser.add_argument("oad_scores")
+    parser.add_argument("obj_tracking_output")
+    parser.add_argument("--params", default="params.json")
+    parser.add_argument("--output", default=RESULTS_PATH, help="directory for buffer logs")
+    parser.add_argument("--log-level", default="WARNING",
+                        help="logging level; DEBUG logs every frame and DMM transition")
+    parser.add_argument("--metrics", help="write run metrics here, as Prometheus text for .prom/.txt and JSON otherwise")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the last checkpoint in the output directory instead of starting over")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(message)s")
+    sbb = SingleSBB(args.frames_dir, args.vad_scores, args.oad_scores, args.obj_tracking_output,
+                    params=load_params(args.params), results_path=args.output, resume=args.resume)
     sbb.run()
+    if args.metrics:
+        sbb.metrics.export(args.metrics)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
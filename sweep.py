@@ -0,0 +1,208 @@
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import itertools
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sbb import SingleSBB, reset_results_dir
+from FrameManifest import FrameManifest
+from FrameHash import FrameHashes
+from TrackIndex import TrackIndex
+from TrackingOutput import CSRTracking, load_tracking, to_csr
+from ValueEngine import ValueEngine, normalize_vad, value_config
+from Params import load_params, with_defaults
+
+logger = logging.getLogger(__name__)
+
+SWEEP_PATH = "sweep_output"
+
+# Counters summed into each configuration's summary row
+SUMMARY_COUNTERS = ("buffers_pushed", "buffers_rejected", "buffers_evicted", "buffers_degraded")
+
+def expand_grid(grid):
+    # A dict of lists is a cartesian grid of params overrides, a list is taken as the overrides themselves
+    if isinstance(grid, list):
+        return grid
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+def csv_value(value):
+    # Lists and dicts of params values are written as JSON
+    return json.dumps(value) if isinstance(value, (list, dict)) else value
+
+class SharedArrays:
+    # Arrays copied once into shared memory so worker processes can map them instead of loading their own
+
+    def __init__(self):
+        self.blocks = []
+        self.specs = {}
+
+    def add(self, name, array):
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        self.blocks.append(block)
+        self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+# Inputs mapped by each worker process once, in init_worker
+_shared = {}
+
+def init_worker(specs, frame_path, names, mtime_ns):
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared[name] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    _shared["manifest"] = FrameManifest(frame_path, names, _shared["sizes"][1], mtime_ns)
+    _shared["track_index"] = None
+    if "track_index_words" in _shared:
+        _shared["track_index"] = TrackIndex({name: _shared["track_index_" + name][1] for name in TrackIndex.ARRAYS})
+    _shared["frame_hashes"] = None
+    if "hashes" in _shared:
+        _shared["frame_hashes"] = FrameHashes(frame_path, _shared["hashes"][1], _shared["hash_valid"][1], mtime_ns)
+
+def run_config(config_index, params, value_index, out_path):
+    # Runs one configuration on the shared inputs and returns its summary
+    inputs = {"manifest": _shared["manifest"],
+              "vad_scores": _shared["vad_scores"][1],
+              "data_values": _shared["values" + str(value_index)][1],
+              "tracking": CSRTracking(_shared["indptr"][1], _shared["track_ids"][1]),
+              "track_index": _shared["track_index"],
+              "frame_hashes": _shared["frame_hashes"]}
+    start = time.perf_counter()
+    sbb = SingleSBB(None, None, None, None, params=params, results_path=out_path, inputs=inputs)
+    sbb.run()
+
+    counters = {name: 0 for name in SUMMARY_COUNTERS}
+    for (name, labels), value in sbb.metrics.counters.items():
+        if name in counters:
+            counters[name] += value
+    summary = {"config": config_index, "value_kept": sbb.priorityq.value, "bytes_kept": sbb.priorityq.cost,
+               "buffers_kept": len(sbb.priorityq)}
+    summary.update(counters)
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+class Sweep:
+    # Class for running SingleSBB over a grid of params overrides on inputs loaded once
+
+    def __init__(self, frame_path, vad_path, oad_path, tracking_path, grid, params=None,
+                 results_path=SWEEP_PATH, workers=None):
+        """
+        @param grid: dict of lists of params values to combine, or a list of params overrides
+        @param dict params: base parameters, read from params.json if not given
+        @param str results_path: output directory, with one subdirectory per configuration and summary.csv
+        @param int workers: number of worker processes, the CPU count by default
+        """
+        self.frame_path = frame_path
+        self.vad_path = vad_path
+        self.oad_path = oad_path
+        self.tracking_path = tracking_path
+        self.overrides = expand_grid(grid)
+        self.params = with_defaults(params) if params is not None else load_params()
+        self.results_path = results_path
+        self.workers = workers
+
+        # Checkpoints are per run and sweeps don't resume
+        self.configs = [dict(self.params, **overrides, checkpoint_interval=0) for overrides in self.overrides]
+
+        reset_results_dir(self.results_path)
+
+    def loadInputs(self, shared):
+        # Loads frame sizes, scores, tracking, its index and frame hashes once and computes values once per value config
+        # Returns the value array index of each configuration
+        manifest = FrameManifest.load(self.frame_path)
+        shared.add("sizes", manifest.sizes)
+
+        vad_scores = normalize_vad(np.load(self.vad_path))
+        oad_scores = np.load(self.oad_path)
+        shared.add("vad_scores", vad_scores)
+
+        tracking_output = load_tracking(self.tracking_path)
+        if isinstance(tracking_output, CSRTracking):
+            indptr, track_ids = tracking_output.indptr, tracking_output.track_ids
+        else:
+            indptr, track_ids = to_csr(tracking_output)
+        shared.add("indptr", indptr)
+        shared.add("track_ids", track_ids)
+
+        # The track index and frame hashes are built here, so workers don't each build them and write the same cache
+        if any(config["track_index"] and config["bulk_stepping"] for config in self.configs):
+            track_index = TrackIndex.load(self.tracking_path, tracking_output)
+            for name in TrackIndex.ARRAYS:
+                shared.add("track_index_" + name, getattr(track_index, name))
+        if any(config["dedup"] for config in self.configs):
+            frame_hashes = FrameHashes.load(manifest, self.params["dedup_workers"])
+            shared.add("hashes", frame_hashes.hashes)
+            shared.add("hash_valid", frame_hashes.valid)
+
+        value_indices = {}
+        config_values = []
+        for config in self.configs:
+            key = value_config(config)
+            if key not in value_indices:
+                value_indices[key] = len(value_indices)
+                logger.info("Computing values for value config %d", value_indices[key])
+                shared.add("values" + str(value_indices[key]), ValueEngine(config).compute(vad_scores, oad_scores))
+            config_values.append(value_indices[key])
+        return manifest, config_values
+
+    def run(self):
+        shared = SharedArrays()
+        try:
+            manifest, config_values = self.loadInputs(shared)
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                     initargs=(shared.specs, manifest.frame_path, manifest.names,
+                                               manifest.mtime_ns)) as pool:
+                futures = [pool.submit(run_config, i, config, config_values[i],
+                                       os.path.join(self.results_path, "config" + str(i)))
+                           for i, config in enumerate(self.configs)]
+                summaries = [future.result() for future in futures]
+        finally:
+            shared.close()
+
+        self.writeSummary(summaries)
+        return summaries
+
+    def writeSummary(self, summaries):
+        # Writes summary.csv with each configuration's overrides and results
+        override_names = list(dict.fromkeys(name for overrides in self.overrides for name in overrides))
+        with open(os.path.join(self.results_path, "summary.csv"), 'w', newline="") as summary_out:
+            writer = csv.writer(summary_out)
+            writer.writerow(["config"] + override_names + list(summaries[0])[1:])
+            for overrides, summary in zip(self.overrides, summaries):
+                writer.writerow([summary["config"]] + [csv_value(overrides.get(name)) for name in override_names] +
+                                list(summary.values())[1:])
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run the Smart Black Box over a grid of parameters")
+    parser.add_argument("frames_dir")
+    parser.add_argument("vad_scores")
+    parser.add_argument("oad_scores")
+    parser.add_argument("obj_tracking_output")
+    parser.add_argument("grid", help='JSON file with lists of values per parameter, e.g. {"eta": [0.8, 0.9]}, '
+                                     'or a list of parameter overrides')
+    parser.add_argument("--params", default="params.json", help="base parameters the grid overrides")
+    parser.add_argument("--output", default=SWEEP_PATH, help="directory for per-configuration output and summary.csv")
+    parser.add_argument("--workers", type=int, help="worker processes, the CPU count by default")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(message)s")
+    sweep = Sweep(args.frames_dir, args.vad_scores, args.oad_scores, args.obj_tracking_output,
+                  json.load(open(args.grid)), params=load_params(args.params),
+                  results_path=args.output, workers=args.workers)
+    sweep.run()
+    with open(os.path.join(args.output, "summary.csv")) as summary_in:
+        print(summary_in.read(), end="")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
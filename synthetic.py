@@ -0,0 +1,130 @@
+import os
+import sys
+import argparse
+import numpy as np
+from TrackingOutput import to_csr
+
+# Synthetic recordings for exercising the SBB without real footage
+# Writes a frames directory, VAD and OAD scores and object tracking output in the formats sbb.py reads
+
+def anomaly_mask(num_frames, rng, burst_rate=0.002, burst_length=120):
+    # Marks frames inside anomaly bursts starting at burst_rate per frame with mean length burst_length
+    starts = np.flatnonzero(rng.random(num_frames) < burst_rate)
+    lengths = rng.poisson(burst_length, len(starts))
+    mask = np.zeros(num_frames + 1, dtype=np.int64)
+    np.add.at(mask, starts, 1)
+    np.add.at(mask, np.minimum(starts + lengths, num_frames), -1)
+    return np.cumsum(mask[:-1]) > 0
+
+def synthetic_scores(num_frames, rng, anomalies, num_classes=17, burst_height=0.6, noise=0.15):
+    # VAD scores that rise during anomalies and OAD class probabilities that move off background (class 0)
+    vad_scores = rng.random(num_frames) * noise + anomalies * burst_height
+
+    logits = rng.normal(0.0, 1.0, (num_frames, num_classes))
+    logits[:,0] += np.where(anomalies, -1.0, 3.0)
+    oad_scores = np.exp(logits)
+    oad_scores /= np.sum(oad_scores, axis=1)[:,None]
+    return vad_scores, oad_scores.astype(np.float32)
+
+def synthetic_tracks(num_frames, rng, mean_tracks=8, track_churn=0.03):
+    # Per-frame track ID lists where each track ends with probability track_churn per frame
+    # and new tracks start at a rate keeping mean_tracks active on average
+    births = rng.poisson(mean_tracks * track_churn, num_frames)
+    active = list(range(mean_tracks))
+    next_id = mean_tracks
+    tracking_output = []
+    for i in range(num_frames):
+        survived = rng.random(len(active)) >= track_churn
+        active = [track_id for track_id, keep in zip(active, survived) if keep]
+        active.extend(range(next_id, next_id + births[i]))
+        next_id += births[i]
+        tracking_output.append(list(active))
+    return tracking_output
+
+def to_object_array(tracking_output):
+    # Packs per-frame lists into a 1-D object array, even when every list has the same length
+    packed = np.empty(len(tracking_output), dtype=object)
+    for i, track_ids in enumerate(tracking_output):
+        packed[i] = track_ids
+    return packed
+
+def write_frames(frame_path, sizes, sparse=True):
+    # Writes one dummy frame file per size, as sparse files unless sparse is False
+    os.makedirs(frame_path, exist_ok=True)
+    digits = len(str(len(sizes)))
+    for i, size in enumerate(sizes.tolist()):
+        with open(os.path.join(frame_path, "{:0{}d}.jpg".format(i, digits)), 'wb') as frame_out:
+            if sparse:
+                frame_out.truncate(size)
+            else:
+                frame_out.write(os.urandom(size))
+
+def write_images(frame_path, num_frames, rng, width=640, height=360, quality=90):
+    # Writes real JPEG frames of a drifting gradient with noise, for exercising real compression
+    from PIL import Image
+    os.makedirs(frame_path, exist_ok=True)
+    digits = len(str(num_frames))
+    x = np.linspace(0, 255, width)[None,:,None]
+    y = np.linspace(0, 255, height)[:,None,None]
+    for i in range(num_frames):
+        shift = (i * 3) % 256
+        pixels = (x + y * np.array([0.3, 0.6, 0.9]) + shift) % 256 + rng.normal(0, 12, (height, width, 3))
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+        image.save(os.path.join(frame_path, "{:0{}d}.jpg".format(i, digits)), "JPEG", quality=quality)
+
+def generate_recording(out_path, num_frames, seed=0, frame_size=60000, frame_size_std=15000,
+                       burst_rate=0.002, burst_length=120, burst_height=0.6,
+                       mean_tracks=8, track_churn=0.03, tracking_format="pickle", sparse=True, images=False):
+    # Generates a recording in out_path and returns the paths sbb.py takes
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_path, exist_ok=True)
+    paths = {"frames": os.path.join(out_path, "frames"),
+             "vad": os.path.join(out_path, "vad.npy"),
+             "oad": os.path.join(out_path, "oad.npy")}
+
+    if images:
+        write_images(paths["frames"], num_frames, rng)
+    else:
+        sizes = np.maximum(rng.normal(frame_size, frame_size_std, num_frames), 1).astype(np.int64)
+        write_frames(paths["frames"], sizes, sparse)
+
+    anomalies = anomaly_mask(num_frames, rng, burst_rate, burst_length)
+    vad_scores, oad_scores = synthetic_scores(num_frames, rng, anomalies, burst_height=burst_height)
+    np.save(paths["vad"], vad_scores)
+    np.save(paths["oad"], oad_scores)
+
+    tracking_output = synthetic_tracks(num_frames, rng, mean_tracks, track_churn)
+    if tracking_format == "csr":
+        paths["tracking"] = os.path.join(out_path, "tracking.npz")
+        indptr, track_ids = to_csr(tracking_output)
+        with open(paths["tracking"], 'wb') as tracking_out:
+            np.savez(tracking_out, indptr=indptr, track_ids=track_ids)
+    else:
+        paths["tracking"] = os.path.join(out_path, "tracking.npy")
+        np.save(paths["tracking"], to_object_array(tracking_output), allow_pickle=True)
+    return paths
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Generate a synthetic SBB recording")
+    parser.add_argument("out_dir")
+    parser.add_argument("--frames", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--frame-size", type=int, default=60000, help="mean frame file size in bytes")
+    parser.add_argument("--frame-size-std", type=int, default=15000)
+    parser.add_argument("--burst-rate", type=float, default=0.002, help="anomaly bursts started per frame")
+    parser.add_argument("--burst-length", type=int, default=120, help="mean anomaly burst length in frames")
+    parser.add_argument("--burst-height", type=float, default=0.6, help="VAD score added during bursts")
+    parser.add_argument("--mean-tracks", type=int, default=8, help="mean number of tracked objects per frame")
+    parser.add_argument("--track-churn", type=float, default=0.03, help="per-frame probability a track ends")
+    parser.add_argument("--tracking-format", choices=["pickle", "csr"], default="pickle")
+    parser.add_argument("--dense", action="store_true", help="write frame bytes instead of sparse files")
+    parser.add_argument("--images", action="store_true", help="write real JPEG frames (needs Pillow)")
+    args = parser.parse_args(argv)
+
+    paths = generate_recording(args.out_dir, args.frames, args.seed, args.frame_size, args.frame_size_std,
+                               args.burst_rate, args.burst_length, args.burst_height,
+                               args.mean_tracks, args.track_churn, args.tracking_format, not args.dense, args.images)
+    print("python3 sbb.py {} {} {} {}".format(paths["frames"], paths["vad"], paths["oad"], paths["tracking"]))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,25 @@
+import numpy as np
+from IBCC import IBCC, ibcc_probs
+
+CONFUSION_PRIOR = {"VAD": [[65589, 23681], [18793, 23617]], "OAD": [[65589, 23681], [18793, 23617]]}
+
+def test_batch_inference_matches_per_frame():
+    # inferVB_batch gives every frame the estimate inferVB gives it alone, and leaves the priors untouched
+    rng = np.random.default_rng(0)
+    vad_probs, oad_probs = ibcc_probs(rng.random(200), rng.random((200, 17)))
+    ibcc = IBCC(CONFUSION_PRIOR, [50, 50])
+    batch = ibcc.inferVB_batch(vad_probs, oad_probs)
+    for i in range(len(vad_probs)):
+        np.testing.assert_allclose(batch[i], ibcc.inferVB({"VAD": vad_probs[i], "OAD": oad_probs[i]}), atol=1e-12)
+    np.testing.assert_array_equal(ibcc.class_prob_prior_init, [50, 50])
+    np.testing.assert_array_equal(ibcc.confusion_prior_init["VAD"], CONFUSION_PRIOR["VAD"])
+
+def test_priors_are_not_mutated():
+    # Building the combiner and running inference leaves the caller's priors as they were
+    confusion_prior = {classifier: [list(row) for row in prior] for classifier, prior in CONFUSION_PRIOR.items()}
+    class_prob_prior = [50, 50]
+    ibcc = IBCC(confusion_prior, class_prob_prior)
+    first = ibcc.inferVB({"VAD": [0.2, 0.8], "OAD": [0.6, 0.4]})
+    ibcc.inferVB({"VAD": [0.9, 0.1], "OAD": [0.1, 0.9]})
+    assert confusion_prior == CONFUSION_PRIOR and class_prob_prior == [50, 50]
+    np.testing.assert_array_equal(ibcc.inferVB({"VAD": [0.2, 0.8], "OAD": [0.6, 0.4]}), first)
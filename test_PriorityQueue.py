@@ -0,0 +1,48 @@
+import os
+import threading
+from BufferWriter import BufferWriter, JSONLogs
+from DataFrame import DataFrame
+from PriorityQueue import PriorityQ, DegradePolicy
+from buffer import Buffer
+
+class GatedLogs(JSONLogs):
+    # JSON backend whose writes wait for gate, so later operations stay pending in the writer
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def write(self, log_addr, log, sync=False):
+        self.gate.wait()
+        return super().write(log_addr, log, sync)
+
+def make_buffer(buffer_index, num_frames=20):
+    buffer = Buffer()
+    for i in range(num_frames):
+        buffer.append(DataFrame("frame" + str(i), i, 0.5 + 0.01 * buffer_index, 0.5, [i], cost=1024))
+    buffer.setBufferIndex(buffer_index)
+    buffer.generateDecision(0.9, 1.7)
+    buffer.fakeCompress()
+    return buffer
+
+def test_evicting_degraded_buffer_removes_its_log(tmp_path):
+    # A buffer degraded and then evicted while its rewritten log is still pending must not leave its first log behind
+    backend = GatedLogs()
+    writer = BufferWriter(backend=backend)
+    first = make_buffer(0)
+    max_memory_mb = 1.5 * first.totalCost() / (1024 * 1024)
+    priorityq = PriorityQ(max_memory_mb, 1.001, writer=writer, policy=DegradePolicy(0.9, 1.7, 0.99, steps=1))
+    priorityq.fakePush(first, str(tmp_path))
+    writer.flush()
+
+    # Hold the writer on the second buffer's log so the degraded rewrites are still pending when buffers are evicted
+    backend.gate.clear()
+    priorityq.fakePush(make_buffer(1), str(tmp_path))
+    backend.gate.set()
+    for buffer_index in list(priorityq.records):
+        priorityq.remove(buffer_index)
+    writer.close()
+
+    counters = {name: value for (name, _), value in priorityq.metrics.counters.items()}
+    assert counters["buffers_degraded"] > 0 and counters["buffers_evicted"] > 0
+    assert os.listdir(tmp_path) == []
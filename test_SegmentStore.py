@@ -0,0 +1,25 @@
+import os
+import numpy as np
+from SegmentStore import SegmentStore, SegmentReader, _segmentName
+
+def make_log(num_frames):
+    return {"value": np.linspace(0, 1, num_frames), "cost": np.full(num_frames, 100.0),
+            "frame": np.arange(num_frames), "decision": np.ones(num_frames)}
+
+def test_torn_record_is_truncated(tmp_path):
+    # Reopening a store after a crash mid-record cuts the torn bytes off its segment and keeps the complete records
+    store = SegmentStore(str(tmp_path))
+    store.write(os.path.join(str(tmp_path), "priority_buffer0_log.json"), make_log(10))
+    store.close()
+    segment_path = os.path.join(str(tmp_path), "segments", _segmentName(0))
+    complete_size = os.path.getsize(segment_path)
+    with open(segment_path, 'ab') as segment_out:
+        segment_out.write(b"SBBR\x00\x00\x11\x00torn")
+
+    store = SegmentStore(str(tmp_path))
+    store.close()
+    assert os.path.getsize(segment_path) == complete_size
+    assert store.total_bytes == complete_size - len(b"SBBSEG01")
+    reader = SegmentReader(str(tmp_path))
+    assert reader.names() == ["priority_buffer0"]
+    np.testing.assert_array_equal(reader.read("priority_buffer0")["frame"], np.arange(10))
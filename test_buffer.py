@@ -0,0 +1,105 @@
+import random
+from collections import Counter
+import numpy as np
+from DataFrame import DataFrame
+from buffer import Buffer, gaussian
+
+class ListBuffer:
+    # Plain-list buffer the shared columnar Buffer should behave like, one (index, value, track IDs) tuple per frame
+
+    def __init__(self):
+        self.frames = []
+
+    def check(self, buffer):
+        assert buffer.size() == len(self.frames)
+        assert buffer.index.tolist() == [frame[0] for frame in self.frames]
+        assert buffer.value.tolist() == [frame[1] for frame in self.frames]
+        assert buffer.cost.tolist() == [frame[0] * 10.0 for frame in self.frames]
+        assert buffer.data_ptrs.tolist() == ["frame" + str(frame[0]) for frame in self.frames]
+        track_counts = Counter(track_id for frame in self.frames for track_id in frame[2])
+        assert buffer.track_counts == track_counts
+        assert sorted(buffer.objects) == sorted(track_counts)
+
+def random_slice(rng, size):
+    # Slice bounds like the DMM's, including negative and missing ones
+    bounds = [None] + list(range(-size - 1, size + 2))
+    return rng.choice(bounds), rng.choice(bounds)
+
+def test_buffer_operations_match_lists():
+    # Random appends, extends, copies, splits and column writes over buffers sharing rows give the same frames
+    # and track counts as plain lists, and writing one buffer's column never changes another's
+    rng = random.Random(0)
+    buffers = [Buffer(capacity=4) for _ in range(4)]
+    models = [ListBuffer() for _ in range(4)]
+    next_index = 0
+    for step in range(3000):
+        target = rng.randrange(4)
+        source = rng.randrange(4)
+        buffer, model = buffers[target], models[target]
+        operation = rng.choice(["append", "append", "extend", "copy", "split", "write", "detach"])
+        if operation == "append":
+            track_ids = rng.sample(range(12), rng.randrange(4))
+            frame = DataFrame("frame" + str(next_index), next_index, rng.random(), 0.0, track_ids,
+                              cost=next_index * 10.0)
+            buffer.append(frame)
+            model.frames.append((next_index, frame.value, track_ids))
+            next_index += 1
+        elif operation == "extend":
+            start, end = random_slice(rng, buffers[source].size())
+            frames = models[source].frames[start:end]
+            buffer.extend(buffers[source], start, end)
+            model.frames.extend(frames)
+        elif operation == "copy":
+            start, end = random_slice(rng, buffers[source].size())
+            buffer.copy(buffers[source], start, end)
+            model.frames = list(models[source].frames[start:end])
+        elif operation == "split":
+            start, end = random_slice(rng, buffer.size())
+            buffer.split(start, end)
+            model.frames = model.frames[start:end]
+        elif operation == "write":
+            values = [rng.random() for _ in model.frames]
+            buffer.value = np.array(values)
+            model.frames = [(frame[0], value, frame[2]) for frame, value in zip(model.frames, values)]
+        else:
+            buffer.detach()
+        for buffer, model in zip(buffers, models):
+            model.check(buffer)
+
+def test_similarity_matches_sets():
+    # calcSimilarity is the fraction of a frame's track IDs anywhere in the buffer
+    buffer = Buffer()
+    for i, track_ids in enumerate([[1, 2], [2, 3], [4]]):
+        buffer.append(DataFrame("frame" + str(i), i, 0.5, 0.0, track_ids, cost=1.0))
+    assert buffer.calcSimilarity([1, 5]) == 0.5
+    assert buffer.calcSimilarity([3, 4, 2]) == 1.0
+    assert buffer.calcSimilarity([]) == 0.0
+    buffer.split(split_from=2)
+    assert buffer.calcSimilarity([1, 4]) == 0.5
+
+def loop_filter(values, sigma):
+    # The original frame-by-frame filterValue
+    N = len(values)
+    filtered_value = list(values)
+    for i in range(1, N):
+        if values[i] > values[i-1]:
+            a = values[i] - values[i-1]
+            for j in range(max(i - 3*sigma, 0), i):
+                filtered_value[j] = max(filtered_value[j], gaussian(j, a, i, sigma))
+        elif values[i] < values[i-1]:
+            a = values[i-1] - values[i]
+            for j in range(i, min(i + 3*sigma, N)):
+                filtered_value[j] = max(filtered_value[j], gaussian(j, a, i, sigma))
+    return filtered_value
+
+def test_filter_value_matches_loop():
+    # The vectorized filter gives the original loop's values, with repeated values, plateaus and short buffers
+    rng = np.random.default_rng(0)
+    for size in (0, 1, 2, 5, 40, 300):
+        for sigma in (1, 3, 5):
+            values = np.round(rng.random(size), 1)
+            buffer = Buffer()
+            for i, value in enumerate(values):
+                buffer.append(DataFrame("frame" + str(i), i, value, 0.0, [], cost=1.0))
+            buffer.filterValue(sigma)
+            np.testing.assert_allclose(buffer.value, loop_filter(values.tolist(), sigma), rtol=0, atol=1e-12)
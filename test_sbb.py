@@ -0,0 +1,33 @@
+import os
+from Params import load_params
+from sbb import SingleSBB
+from synthetic import generate_recording
+
+PARAMS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "params.json")
+
+def run_logs(paths, results_path, **overrides):
+    # Runs the SBB over a recording and returns its buffer logs by name and its DMM transition counts
+    params = dict(load_params(PARAMS_PATH), **overrides)
+    sbb = SingleSBB(paths["frames"], paths["vad"], paths["oad"], paths["tracking"], params=params,
+                    results_path=results_path)
+    sbb.run()
+    logs = {}
+    for name in os.listdir(results_path):
+        with open(os.path.join(results_path, name)) as log_in:
+            logs[name] = log_in.read()
+    transitions = {labels: value for (name, labels), value in sbb.metrics.counters.items()
+                   if name == "dmm_transitions"}
+    return logs, transitions
+
+def test_bulk_stepping_matches_per_frame(tmp_path):
+    # Bulk stepping, with or without the track index, leaves the same buffer logs and DMM transitions as stepping
+    # every frame, with thresholds and buffer sizes that take the DMM through every action
+    paths = generate_recording(str(tmp_path / "recording"), 6000, seed=3, burst_rate=0.01, burst_length=40,
+                               mean_tracks=4, track_churn=0.05)
+    small = {"major_buffer_max": 200, "wait_buffer_max": 50, "pre_buffer_min": 30, "value_threshold": 0.7,
+             "similarity_threshold": 0.8, "max_memory_mb": 64}
+    logs, transitions = run_logs(paths, str(tmp_path / "frames"), bulk_stepping=0, **small)
+    assert len(logs) > 5 and len(transitions) == 7
+    for track_index in (0, 1):
+        results_path = str(tmp_path / ("bulk" + str(track_index)))
+        assert run_logs(paths, results_path, bulk_stepping=1, track_index=track_index, **small) == (logs, transitions)